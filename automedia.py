@@ -7,11 +7,31 @@ import sys
 import time
 import json
 import uuid
+import shutil
 import errno
+import atexit
+import fcntl
 import signal
+import select
+import threading
+import heapq
+import queue
+import urllib.parse
+import hashlib
+import csv
+import io
+import sqlite3
+import importlib.util
+import importlib.machinery
+import requests
 import transmissionrpc
 
+from concurrent.futures import ThreadPoolExecutor, Future
+
 from domain import url_extract_domain
+from state_db import StateDb
+from rate_limiter import HostRateLimiter
+from metrics import Metrics
 
 from lxml import etree
 from datetime import datetime
@@ -22,20 +42,165 @@ config_dir = os.path.expanduser("~/.config/automedia")
 rss_config_dir = os.path.join(config_dir, "rss")
 html_config_dir = os.path.join(config_dir, "html")
 automedia_pid_path = "/tmp/automedia.pid"
+# If this file exists then the state of tracked items is stored in it instead of in the tracked item directories.
+# It's created with the "migrate" command.
+state_db_path = os.path.join(config_dir, "state.db")
+# Downloaded items of all tracked media sorted by time from the oldest to the newest, one json item per line.
+# Used by the "downloaded" command when the sqlite backend isn't used
+downloaded_index_path = os.path.join(config_dir, "downloaded")
 
 only_show_finished_notification = True
 
+# Timers and counters of the sync command are written to this file in the prometheus text format every metrics_write_rate_sec
+metrics_file_path = os.path.join(config_dir, "metrics.prom")
+metrics_write_rate_sec = 60
+# Set to a port number to also serve the metrics on http://127.0.0.1:<port>/metrics while syncing
+metrics_http_port = None
+metrics = Metrics()
+
+# Number of rss feeds that are downloaded and parsed at the same time
+rss_fetch_workers = 8
+# Parse feeds while they are being downloaded and stop downloading at the first item that has already been downloaded,
+# instead of downloading and parsing the whole feed with feedparser. Feeds that can't be parsed this way are parsed with feedparser
+use_streaming_rss_parser = True
+rss_fetch_timeout_sec = 30
+# Number of requests that can be made at the same time to the same host (as returned by url_extract_domain)
+max_requests_per_host = 2
+# Number of requests per second that can be made to the same host on average, and the number of requests
+# that can be made at once after being idle. This applies to rss feeds, fetched pages and the page that plugins list or download
+# (the other requests of plugins, for example for images, are not limited)
+requests_per_host_per_sec = 2.0
+request_burst_per_host = 4
+# host (as returned by url_extract_domain) -> (requests per second, burst), for hosts that need a different rate
+host_request_rates = {}
+
+# Number of the latest downloaded items that are sent as they are to plugins that support fingerprints. The older items are only sent as
+# hashes of their titles and urls (see build_plugin_list_input)
+plugin_list_input_window = 50
+# Number of hex characters of the sha1 hashes that are sent to plugins
+plugin_list_input_hash_length = 12
+# Maximum number of older items that are sent as hashes. Plugins stop listing at the first item that has been downloaded,
+# so the older items are only needed when none of the newer ones are in the list anymore
+plugin_list_fingerprint_size = 1000
+
+# Maximum number of pages of a feed that are fetched when the last downloaded item isn't on the first page
+# (for example after automedia hasn't been running for a while)
+rss_max_pages = 10
+
+# Number of html items that are synced (plugin list and download) at the same time
+html_sync_workers = 4
+# Number of plugin processes (or requests to the plugin worker) that can run at the same time for the same plugin
+max_processes_per_plugin = 2
+# Load python plugins that expose list_chapters and download_chapter functions into this process and call them directly,
+# instead of running them in a separate process. Only plugins that have a python_plugin_marker line are loaded
+use_python_plugins = True
+python_plugin_marker = "# automedia: in-process"
+# Run plugins that support it as long-lived workers (see PluginWorker) instead of starting a new process for every list and download
+use_plugin_workers = True
+# Number of seconds to wait for a plugin to start in worker mode, before falling back to running it once per command
+plugin_worker_start_timeout_sec = 5
+
+host_rate_limiter = HostRateLimiter(requests_per_host_per_sec, request_burst_per_host, host_request_rates)
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+# http session used to download feeds with the streaming parser
+rss_http_session = requests.Session()
+rss_http_session.headers["User-Agent"] = feedparser.USER_AGENT
+plugin_semaphores = {}
+plugin_semaphores_lock = threading.Lock()
+# real path of plugin -> loaded python module, or None if the plugin can't be loaded in-process
+python_plugins = {}
+python_plugins_lock = threading.Lock()
+# http session shared by all python plugins that are loaded in-process
+plugin_http_session = None
+# plugin name -> PluginWorker, or None if the plugin doesn't support worker mode
+plugin_workers = {}
+plugin_workers_lock = threading.Lock()
+
+# Port of the rpc interface of the transmission daemon
+torrent_rpc_port = 9091
+# Number of times adding a torrent is retried (with exponential backoff) before giving up until the next sync
+torrent_add_retries = 2
+torrent_add_retry_delay_sec = 1.0
+# Transmission stops seeding a torrent when its upload ratio reaches this
+torrent_seed_ratio = 2.0
+# Finished torrents are removed from transmission (the downloaded files are kept) when they have reached torrent_seed_ratio
+# or have been seeding for torrent_max_seed_time_sec (None to only use the ratio), so transmission doesn't get slower with every download
+remove_seeded_torrents = True
+torrent_max_seed_time_sec = 30 * 24 * 60 * 60
+# How often sync checks for torrents to remove
+torrent_removal_check_rate_sec = 60 * 60
+
+# Check each tracked item at a rate based on how often it has released new items, instead of every sync.
+# Items are checked every sync when a new item is expected, less often before that and with exponential backoff
+# (up to max_sync_interval_sec) when new items haven't been released for a long time (finished or dropped series)
+adaptive_sync = True
+max_sync_interval_sec = 24 * 60 * 60
+# Number of latest releases that are used to find the release interval of an item
+release_history_size = 10
+# Items that were downloaded within this many seconds of each other are counted as one release
+release_group_sec = 60 * 60
+# Release interval used for items that don't have enough releases to find the release interval.
+# Such items are checked every sync until they haven't released anything for this long
+default_release_interval_sec = 14 * 24 * 60 * 60
+# Items are checked every sync starting from this fraction of the release interval before the next release is expected
+release_early_check_fraction = 0.25
+
+# Tracked items that still have an ".in_progress" file this many seconds after they started being added are removed
+# (adding them was interrupted, for example by a crash). Html downloads that have been in progress this long
+# and are not running anymore are resumed
+in_progress_timeout_sec = 60 * 60
+# How often sync checks for interrupted adds and downloads, they are also checked when sync starts
+in_progress_sweep_rate_sec = 60 * 60
+
+# Set by open_state_db if the sqlite backend is used
+state_db = None
+downloaded_index_lock = threading.Lock()
+torrent_client = None
+torrent_client_lock = threading.Lock()
+
+def normalize_seen_title(title):
+    return title.lower().replace(" ", "")
+
+def get_seen_hash(key):
+    return hashlib.sha1(key.encode()).hexdigest()[:plugin_list_input_hash_length]
+
+# Titles and urls of the downloaded items of a tracked item. It's created when the tracked item is loaded
+# and is updated when an item is downloaded, so the downloaded history doesn't have to be read every sync
+class SeenIndex:
+    def __init__(self, downloaded):
+        self.titles = set()
+        self.urls = set()
+        # (title hash, url hash) of every downloaded item, from the oldest to the newest
+        self.hashes = []
+        for item in downloaded:
+            self.add(item["title"], item.get("url"))
+
+    def add(self, title, url):
+        title = normalize_seen_title(title)
+        self.titles.add(title)
+        if url:
+            self.urls.add(url)
+        self.hashes.append((get_seen_hash(title), get_seen_hash(url) if url else None))
+
+    def contains(self, title, url):
+        return normalize_seen_title(title) in self.titles or (url and url in self.urls)
+
 class TrackedRss:
     title = None
     latest = None
     link = None
     json_data = None
+    synced = None
+    seen = None
 
-    def __init__(self, title, latest, link, json_data):
+    def __init__(self, title, latest, link, json_data, synced=None):
         self.title = title
         self.latest = latest
         self.link = link
         self.json_data = json_data
+        self.synced = synced
+        self.seen = SeenIndex(json_data["downloaded"])
 
 class TrackedHtml:
     title = None
@@ -43,13 +208,19 @@ class TrackedHtml:
     link = None
     plugin = None
     json_data = None
+    synced = None
+    seen = None
+    # Set when the item has downloads that have stopped, which are resumed the next time the item is synced
+    resume_pending = False
 
-    def __init__(self, title, latest, link, plugin, json_data):
+    def __init__(self, title, latest, link, plugin, json_data, synced=None):
         self.title = title
         self.latest = latest
         self.link = link
         self.plugin = plugin
         self.json_data = json_data
+        self.synced = synced
+        self.seen = SeenIndex(json_data["downloaded"])
 
 class TorrentProgress:
     id = None
@@ -61,13 +232,128 @@ class TorrentProgress:
         self.name = name
         self.progress = progress
 
-class HtmlItemProgress:
-    name = None
-    finished = None
+# Keeps track of the html items that are being downloaded, so finished downloads can be detected by only
+# checking the directories of those items instead of every item of every tracked html
+class HtmlDownloadWatcher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # "title/item" -> download directory of the item
+        self.active_items = {}
+
+    def add(self, name, item_dir):
+        with self.lock:
+            self.active_items[name] = item_dir
+
+    def remove(self, name):
+        with self.lock:
+            self.active_items.pop(name, None)
+
+    def is_active(self, name):
+        with self.lock:
+            return name in self.active_items
+
+    # Returns the names of the items that have finished downloading since the last call
+    def get_newly_finished(self):
+        with self.lock:
+            active_items = list(self.active_items.items())
+
+        newly_finished_items = []
+        for name, item_dir in active_items:
+            if os.path.isfile(os.path.join(item_dir, ".finished")):
+                newly_finished_items.append(name)
+
+        with self.lock:
+            for name in newly_finished_items:
+                self.active_items.pop(name, None)
+        return newly_finished_items
+
+html_download_watcher = HtmlDownloadWatcher()
+
+class PluginWorkerError(Exception):
+    pass
+
+# A plugin running with the "worker" command, which handles list and download requests sent as json lines on stdin
+# and writes a json line response for each request to stdout. Requests are handled in parallel by the worker,
+# so responses are matched to requests by id.
+# The worker writes { "protocol": 1 } when it has started. Plugins that don't support worker mode are detected
+# by not writing that line (they print usage and exit instead) and are run once per command instead.
+# Workers that accept the list input with a fingerprint (see build_plugin_list_input) add "list_fingerprint": true to that line.
+class PluginWorker:
+    def __init__(self, process, supports_list_fingerprint):
+        self.process = process
+        self.supports_list_fingerprint = supports_list_fingerprint
+        self.lock = threading.Lock()
+        self.next_request_id = 1
+        # request id -> Future
+        self.pending_requests = {}
+        self.running = True
+        threading.Thread(target=self._read_responses, daemon=True).start()
+
+    # Returns None if the plugin doesn't support worker mode
+    @staticmethod
+    def start(plugin_path):
+        try:
+            process = subprocess.Popen([plugin_path, "worker"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
 
-    def __init__(self, name, finished):
-        self.name = name
-        self.finished = finished
+        ready, _, _ = select.select([process.stdout], [], [], plugin_worker_start_timeout_sec)
+        handshake = None
+        if ready:
+            try:
+                handshake = json.loads(process.stdout.readline().decode('utf-8'))
+            except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+                pass
+
+        if not isinstance(handshake, dict) or handshake.get("protocol") != 1:
+            process.kill()
+            process.wait()
+            return None
+        return PluginWorker(process, handshake.get("list_fingerprint") is True)
+
+    def is_running(self):
+        return self.running
+
+    # Send @request to the worker and wait for the response. Raises PluginWorkerError if the request failed
+    def request(self, request):
+        future = Future()
+        with self.lock:
+            if not self.running:
+                raise PluginWorkerError("Plugin worker is not running")
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            self.pending_requests[request_id] = future
+            try:
+                self.process.stdin.write((json.dumps(dict(request, id=request_id)) + "\n").encode())
+                self.process.stdin.flush()
+            except OSError as e:
+                del self.pending_requests[request_id]
+                raise PluginWorkerError("Failed to send request to plugin worker, error: {}".format(str(e)))
+
+        response = future.result()
+        if "error" in response:
+            raise PluginWorkerError(response["error"])
+        return response.get("result")
+
+    def _read_responses(self):
+        for line in self.process.stdout:
+            try:
+                response = json.loads(line.decode('utf-8'))
+            except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+                continue
+            with self.lock:
+                future = self.pending_requests.pop(response.get("id"), None)
+            if future:
+                future.set_result(response)
+
+        # The worker exited, fail the requests that are still waiting for a response
+        with self.lock:
+            self.running = False
+            pending_requests = self.pending_requests
+            self.pending_requests = {}
+        for future in pending_requests.values():
+            future.set_result({ "error": "Plugin worker exited" })
+        self.process.wait()
 
 def get_file_content_or_none(path):
     try:
@@ -76,112 +362,414 @@ def get_file_content_or_none(path):
     except FileNotFoundError:
         return None
 
-def get_tracked_rss_by_title(tracked_rss, title):
-    for t in tracked_rss:
-        if t.title == title:
-            return t
-    return None
+def parse_timestamp_or_none(timestamp):
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return None
 
-def get_tracked_rss(rss_tracked_dir, existing_tracked_rss):
+def get_host_semaphore(url):
+    domain = url_extract_domain(url)
+    with host_semaphores_lock:
+        semaphore = host_semaphores.get(domain)
+        if not semaphore:
+            semaphore = threading.BoundedSemaphore(max_requests_per_host)
+            host_semaphores[domain] = semaphore
+        return semaphore
+
+def get_plugin_semaphore(plugin_path):
+    plugin_name = os.path.basename(plugin_path)
+    with plugin_semaphores_lock:
+        semaphore = plugin_semaphores.get(plugin_name)
+        if not semaphore:
+            semaphore = threading.BoundedSemaphore(max_processes_per_plugin)
+            plugin_semaphores[plugin_name] = semaphore
+        return semaphore
+
+# Returns the http validators ("etag" and "modified") that were stored the last time the tracked item was synced
+def get_http_cache(tracked_item_dir):
+    http_cache = get_file_content_or_none(os.path.join(tracked_item_dir, "http_cache"))
+    if not http_cache:
+        return {}
+    try:
+        return json.loads(http_cache)
+    except json.decoder.JSONDecodeError:
+        return {}
+
+def set_http_cache(tracked_item_dir, etag, modified):
+    http_cache_filepath = os.path.join(tracked_item_dir, "http_cache")
+    if not etag and not modified:
+        try:
+            os.remove(http_cache_filepath)
+        except FileNotFoundError:
+            pass
+        return
+
+    with open(http_cache_filepath, "w") as file:
+        json.dump({ "etag": etag, "modified": modified }, file)
+
+# New downloaded items are appended to a journal file next to the data file ("data_journal", one json item per line)
+# instead of rewriting the whole data file. The journal is merged into the data file when it grows larger than this
+data_journal_compact_size = 64 * 1024
+
+def data_journal_read(data_filepath):
+    items = []
+    try:
+        with open(data_filepath + "_journal", "r") as file:
+            for line in file:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    items.append(json.loads(line))
+                except json.decoder.JSONDecodeError:
+                    # The line was only partially written, for example if the computer crashed while appending to it
+                    print("Skipping corrupt line in journal {}".format(data_filepath + "_journal"))
+    except FileNotFoundError:
+        pass
+    return items
+
+# Returns the content of the data file with the items from its journal added to "downloaded", or None if the data file doesn't exist
+def data_file_load(data_filepath):
+    json_data = get_file_content_or_none(data_filepath)
+    if not json_data:
+        return None
+    json_data = json.loads(json_data)
+
+    journal_items = data_journal_read(data_filepath)
+    if journal_items:
+        # Items can be in both the data file and the journal if the computer crashed while compacting
+        downloaded_items = set((item["title"], item.get("time")) for item in json_data["downloaded"])
+        for item in journal_items:
+            if (item["title"], item.get("time")) not in downloaded_items:
+                json_data["downloaded"].append(item)
+                json_data["updated"] = item["time"]
+    return json_data
+
+# Append @line to @file (opened with "a+b") and return the size of the file. If the last line in the file was only partially
+# written (for example if the computer crashed while appending to it) then it's ended first, otherwise @line would be joined
+# with it and both would be skipped as corrupt when the file is read
+def file_append_line(file, line):
+    file.seek(0, os.SEEK_END)
+    if file.tell() > 0:
+        file.seek(-1, os.SEEK_END)
+        if file.read(1) != b"\n":
+            file.write(b"\n")
+    file.write((line + "\n").encode("utf-8"))
+    return file.tell()
+
+def data_file_append(data_filepath, json_data, item):
+    journal_filepath = data_filepath + "_journal"
+    with open(journal_filepath, "a+b") as file:
+        journal_size = file_append_line(file, json.dumps(item))
+
+    # The journal is ignored if there is no data file, which is the case for items that were added by older versions
+    if journal_size >= data_journal_compact_size or not os.path.isfile(data_filepath):
+        data_file_compact(data_filepath, json_data)
+
+# Write @json_data (which should contain the items in the journal) to the data file and remove the journal
+def data_file_compact(data_filepath, json_data):
+    tmp_data_filepath = data_filepath + ".tmp"
+    with open(tmp_data_filepath, "w") as file:
+        json.dump(json_data, file, indent=4)
+    os.replace(tmp_data_filepath, data_filepath)
+
+    try:
+        os.remove(data_filepath + "_journal")
+    except FileNotFoundError:
+        pass
+
+# Append @items, a list of (type, tracked title, title), to the downloaded index and return the time they were downloaded.
+# Both sync and add append to the index, so the time is taken while the index file is locked to keep the index sorted by time.
+# The index is created by downloaded_index_build when it's needed
+def downloaded_index_append(items):
+    with downloaded_index_lock:
+        if not os.path.isfile(downloaded_index_path):
+            return str(time.time())
+        with open(downloaded_index_path, "a+b") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            item_time = str(time.time())
+            for media_type, tracked_title, title in items:
+                file_append_line(file, json.dumps({ "type": media_type, "tracked_title": tracked_title, "title": title, "time": item_time }))
+            return item_time
+
+def open_state_db():
+    global state_db
+    if not state_db and os.path.isfile(state_db_path):
+        state_db = StateDb(state_db_path)
+    return state_db
+
+def load_tracked_rss(rss_tracked_dir, title):
+    in_progress = get_file_content_or_none(os.path.join(rss_tracked_dir, title, ".in_progress"))
+    if in_progress:
+        print("Skipping in-progress rss %s" % title)
+        return None
+    link = get_file_content_or_none(os.path.join(rss_tracked_dir, title, "link"))
+    state = state_db.get_tracked("rss", title) if state_db else None
+    if state:
+        if not link:
+            print("Rss corrupt, link missing for rss %s" % title)
+            return None
+        latest, updated, synced, downloaded = state
+        return TrackedRss(title, latest, link, { "link": link, "updated": updated, "downloaded": downloaded }, parse_timestamp_or_none(synced))
+
+    latest = get_file_content_or_none(os.path.join(rss_tracked_dir, title, "latest"))
+    json_data = data_file_load(os.path.join(rss_tracked_dir, title, "data"))
+    if not json_data:
+        updated = str(time.time())
+        json_data = {
+            "link": link,
+            "updated": updated,
+            "downloaded": []
+        }
+        if latest:
+            json_data["downloaded"].append({ "title": latest, "time": updated })
+    if not link or not json_data:
+        print("Rss corrupt, link or data missing for rss %s" % title)
+        return None
+    synced = get_file_content_or_none(os.path.join(rss_tracked_dir, title, "synced"))
+    if state_db:
+        state_db.import_tracked("rss", title, latest, synced, json_data)
+    return TrackedRss(title, latest, link, json_data, parse_timestamp_or_none(synced))
+
+def get_tracked_rss(rss_tracked_dir):
     try:
         tracked_rss = []
         for title in os.listdir(rss_tracked_dir):
-            # Check if we already have the data for the title
-            #if get_tracked_rss_by_title(existing_tracked_rss, title):
-            #    continue
-
-            in_progress = get_file_content_or_none(os.path.join(rss_tracked_dir, title, ".in_progress"))
-            if in_progress:
-                print("Skipping in-progress rss %s" % title)
-                continue
-            latest = get_file_content_or_none(os.path.join(rss_tracked_dir, title, "latest"))
-            link = get_file_content_or_none(os.path.join(rss_tracked_dir, title, "link"))
-            json_data = get_file_content_or_none(os.path.join(rss_tracked_dir, title, "data"))
-            if json_data:
-                json_data = json.loads(json_data)
-            else:
-                updated = str(time.time())
-                json_data = {
-                    "link": link,
-                    "updated": updated,
-                    "downloaded": []
-                }
-                if latest:
-                    json_data["downloaded"].append({ "title": latest, "time": updated })
-            if not link or not json_data:
-                print("Rss corrupt, link or data missing for rss %s" % title)
-                continue
-            tracked_rss.append(TrackedRss(title, latest, link, json_data))
+            rss = load_tracked_rss(rss_tracked_dir, title)
+            if rss:
+                tracked_rss.append(rss)
         return tracked_rss
     except FileNotFoundError:
         return []
 
 def rss_update_latest(rss_tracked_dir, rss, latest, url):
+    if state_db:
+        updated = str(time.time())
+        rss.json_data["updated"] = updated
+        rss.json_data["downloaded"].append({ "title": latest, "time": updated, "url": url })
+        rss.seen.add(latest, url)
+        state_db.update_latest("rss", rss.title, latest, url, updated)
+        return
+
     with open(os.path.join(rss_tracked_dir, rss.title, "latest"), "w") as file:
         file.write(latest)
 
-    updated = str(time.time())
+    updated = downloaded_index_append([("rss", rss.title, latest)])
+
     with open(os.path.join(rss_tracked_dir, rss.title, "updated"), "w") as file:
         file.write(updated)
 
     rss.json_data["updated"] = updated
-    rss.json_data["downloaded"].append({ "title": latest, "time": updated, "url": url })
-    with open(os.path.join(rss_tracked_dir, rss.title, "data"), "w") as file:
-        json.dump(rss.json_data, file, indent=4)
+    item = { "title": latest, "time": updated, "url": url }
+    rss.json_data["downloaded"].append(item)
+    rss.seen.add(latest, url)
+    data_file_append(os.path.join(rss_tracked_dir, rss.title, "data"), rss.json_data, item)
 
 def html_update_latest(html_tracked_dir, html, latest, url):
+    if state_db:
+        updated = str(time.time())
+        html.json_data["updated"] = updated
+        html.json_data["downloaded"].append({ "title": latest, "time": updated, "url": url })
+        html.seen.add(latest, url)
+        state_db.update_latest("html", html.title, latest, url, updated)
+        return
+
     with open(os.path.join(html_tracked_dir, html.title, "latest"), "w") as file:
         file.write(latest)
 
-    updated = str(time.time())
+    updated = downloaded_index_append([("html", html.title, latest)])
+
     with open(os.path.join(html_tracked_dir, html.title, "updated"), "w") as file:
         file.write(updated)
 
     html.json_data["updated"] = updated
-    html.json_data["downloaded"].append({ "title": latest, "time": updated, "url": url })
-    with open(os.path.join(html_tracked_dir, html.title, "data"), "w") as file:
-        json.dump(html.json_data, file, indent=4)
+    item = { "title": latest, "time": updated, "url": url }
+    html.json_data["downloaded"].append(item)
+    html.seen.add(latest, url)
+    data_file_append(os.path.join(html_tracked_dir, html.title, "data"), html.json_data, item)
+
+# Add last synced timestamp. This together with "updated" file is used to remove series
+# that haven't updated in a long time (either finished series or axes series), and to find when @tracked should be synced next
+def tracked_update_synced(tracked_dir, media_type, tracked):
+    synced = time.time()
+    tracked.synced = synced
+    if state_db:
+        state_db.update_synced(media_type, tracked.title, str(synced))
+        return
+
+    with open(os.path.join(tracked_dir, tracked.title, "synced"), "w") as file:
+        file.write(str(synced))
+
+# Returns the times of the latest releases of @tracked, from the oldest to the newest.
+# Items that were downloaded at about the same time (for example when the item was added, or after being offline)
+# are counted as one release
+def get_release_times(tracked):
+    release_times = []
+    for item in tracked.json_data["downloaded"]:
+        item_time = parse_timestamp_or_none(item.get("time"))
+        if item_time is None:
+            continue
+        if release_times and item_time - release_times[-1] < release_group_sec:
+            continue
+        release_times.append(item_time)
+    return release_times[-release_history_size:]
+
+# Returns the number of seconds between syncs of @tracked, which is at least @sync_rate_sec
+def get_sync_interval(tracked, sync_rate_sec, now):
+    release_times = get_release_times(tracked)
+    last_release = release_times[-1] if release_times else parse_timestamp_or_none(tracked.json_data.get("updated"))
+    if last_release is None:
+        return sync_rate_sec
+
+    release_interval = default_release_interval_sec
+    # At least two intervals are needed to find the median
+    if len(release_times) >= 3:
+        intervals = sorted(b - a for a, b in zip(release_times, release_times[1:]))
+        release_interval = intervals[len(intervals) // 2]
+
+        # Check less often until the next release is expected
+        next_release_check = last_release + release_interval * (1.0 - release_early_check_fraction)
+        if now < next_release_check:
+            return min(max(sync_rate_sec, next_release_check - now), max_sync_interval_sec)
+
+    # Double the interval for every release interval that nothing has been released after the expected release
+    missed_releases = (now - last_release) / release_interval - 1.0
+    if missed_releases < 1.0:
+        return sync_rate_sec
+    return max(sync_rate_sec, min(sync_rate_sec * 2.0 ** min(missed_releases, 32.0), max_sync_interval_sec))
+
+# Returns the time when @tracked should be synced next
+def get_next_sync_time(tracked, sync_rate_sec, now):
+    if tracked.synced is None:
+        return now
+    if not adaptive_sync:
+        return tracked.synced + sync_rate_sec
+    return tracked.synced + get_sync_interval(tracked, sync_rate_sec, now)
+
+def load_tracked_html(html_tracked_dir, title):
+    in_progress = get_file_content_or_none(os.path.join(html_tracked_dir, title, ".in_progress"))
+    if in_progress:
+        print("Skipping in-progress html %s" % title)
+        return None
+    link = get_file_content_or_none(os.path.join(html_tracked_dir, title, "link"))
+    if not link:
+        print("html corrupt, link missing for html %s" % title)
+        return None
+    plugin = get_file_content_or_none(os.path.join(html_tracked_dir, title, "plugin"))
+    state = state_db.get_tracked("html", title) if state_db else None
+    if state:
+        if not plugin:
+            print("html corrupt, plugin missing for html %s" % title)
+            return None
+        latest, updated, synced, downloaded = state
+        return TrackedHtml(title, latest, link, plugin, { "plugin": plugin, "link": link, "updated": updated, "downloaded": downloaded }, parse_timestamp_or_none(synced))
+
+    latest = get_file_content_or_none(os.path.join(html_tracked_dir, title, "latest"))
+    json_data = data_file_load(os.path.join(html_tracked_dir, title, "data"))
+    if not json_data:
+        updated = str(time.time())
+        json_data = {
+            "plugin": plugin,
+            "link": link,
+            "updated": updated,
+            "downloaded": []
+        }
+        if latest:
+            json_data["downloaded"].append({ "title": latest, "time": updated })
+    if not plugin or not json_data:
+        print("html corrupt, plugin or data missing for html %s" % title)
+        return None
+    synced = get_file_content_or_none(os.path.join(html_tracked_dir, title, "synced"))
+    if state_db:
+        state_db.import_tracked("html", title, latest, synced, json_data)
+    return TrackedHtml(title, latest, link, plugin, json_data, parse_timestamp_or_none(synced))
 
 def get_tracked_html(html_tracked_dir):
     try:
         tracked_html = []
         for title in os.listdir(html_tracked_dir):
-            in_progress = get_file_content_or_none(os.path.join(html_tracked_dir, title, ".in_progress"))
-            if in_progress:
-                print("Skipping in-progress html %s" % title)
-                continue
-            latest = get_file_content_or_none(os.path.join(html_tracked_dir, title, "latest"))
-            link = get_file_content_or_none(os.path.join(html_tracked_dir, title, "link"))
-            if not link:
-                print("html corrupt, link missing for html %s" % title)
-                continue
-            plugin = get_file_content_or_none(os.path.join(html_tracked_dir, title, "plugin"))
-            json_data = get_file_content_or_none(os.path.join(html_tracked_dir, title, "data"))
-            if json_data:
-                json_data = json.loads(json_data)
-            else:
-                updated = str(time.time())
-                json_data = {
-                    "plugin": plugin,
-                    "link": link,
-                    "updated": updated,
-                    "downloaded": []
-                }
-                if latest:
-                    json_data["downloaded"].append({ "title": latest, "time": updated })
-            if not plugin or not json_data:
-                print("html corrupt, plugin or data missing for html %s" % title)
-                continue
-            tracked_html.append(TrackedHtml(title, latest, link, plugin, json_data))
+            html = load_tracked_html(html_tracked_dir, title)
+            if html:
+                tracked_html.append(html)
         return tracked_html
     except FileNotFoundError:
         return []
 
+# Keeps the tracked items of @tracked_dir in memory between sync cycles, so the files of every item
+# don't have to be read again each cycle. @load_func is load_tracked_rss or load_tracked_html.
+# The tracked directory is only listed again when its mtime changes (an item was added or removed),
+# and only items that have been added, replaced or couldn't be loaded yet (in progress or corrupt) are read.
+# Items that couldn't be loaded are retried when the mtime of their directory changes,
+# which happens for example when the ".in_progress" file is removed.
+class TrackedRegistry:
+    def __init__(self, tracked_dir, load_func):
+        self.tracked_dir = tracked_dir
+        self.load_func = load_func
+        self.dir_mtime = None
+        # title -> (tracked item, inode of the item directory)
+        self.items = {}
+        # title -> mtime of the item directory the last time loading it failed
+        self.pending = {}
+
+    def refresh(self):
+        try:
+            dir_mtime = os.stat(self.tracked_dir).st_mtime_ns
+        except FileNotFoundError:
+            self.dir_mtime = None
+            self.items = {}
+            self.pending = {}
+            return []
+
+        if dir_mtime != self.dir_mtime:
+            self.dir_mtime = dir_mtime
+            self._update_titles(set(os.listdir(self.tracked_dir)))
+
+        for title, last_mtime in list(self.pending.items()):
+            try:
+                item_stat = os.stat(os.path.join(self.tracked_dir, title))
+            except FileNotFoundError:
+                del self.pending[title]
+                continue
+
+            if item_stat.st_mtime_ns == last_mtime:
+                continue
+
+            item = self.load_func(self.tracked_dir, title)
+            if item:
+                self.items[title] = (item, item_stat.st_ino)
+                del self.pending[title]
+            else:
+                self.pending[title] = item_stat.st_mtime_ns
+
+        return self.get_items()
+
+    def get_items(self):
+        return [item for item, _ in self.items.values()]
+
+    def _update_titles(self, titles):
+        for title in list(self.pending.keys()):
+            if title not in titles:
+                del self.pending[title]
+
+        for title, (_, inode) in list(self.items.items()):
+            try:
+                replaced = title not in titles or os.stat(os.path.join(self.tracked_dir, title)).st_ino != inode
+            except FileNotFoundError:
+                replaced = True
+            if replaced:
+                del self.items[title]
+
+        for title in titles:
+            if title not in self.items and title not in self.pending:
+                self.pending[title] = None
+
 # @urgency should either be "low", "normal" or "critical"
 def show_notification(title, body, urgency="normal"):
     subprocess.Popen(["notify-send", "-u", urgency, "--", title, body])
 
 def fetch_page(url):
+    host_rate_limiter.acquire(url)
     process = subprocess.Popen(["curl", "-s", "-L", "--output", "-", url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = process.communicate()
     if process.returncode != 0:
@@ -191,87 +779,155 @@ def fetch_page(url):
         return None
     return stdout.decode('utf-8')
 
+# Run @func with the transmission rpc client. All requests to transmission go through the same client (and http session),
+# which is created on the first request and recreated after a request fails, in case the daemon was restarted.
+# Raises transmissionrpc.TransmissionError or OSError on failure
+def torrent_rpc(func):
+    global torrent_client
+    with torrent_client_lock:
+        try:
+            if not torrent_client:
+                torrent_client = transmissionrpc.Client("127.0.0.1", port=torrent_rpc_port)
+            return func(torrent_client)
+        except (transmissionrpc.TransmissionError, OSError):
+            torrent_client = None
+            raise
+
 def is_torrent_daemon_running():
-    process = subprocess.Popen(["transmission-remote", "-si"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.communicate()
-    return process.returncode == 0
+    try:
+        torrent_rpc(lambda tc: tc.get_session())
+        return True
+    except (transmissionrpc.TransmissionError, OSError):
+        return False
 
 def start_torrent_daemon(download_dir):
-    # TODO: Make seed ratio configurable
-    process = subprocess.Popen(["transmission-daemon", "--global-seedratio", "2.0", "--download-dir", download_dir])
+    process = subprocess.Popen(["transmission-daemon", "--global-seedratio", str(torrent_seed_ratio), "--download-dir", download_dir])
     process.communicate()
+    if process.returncode != 0:
+        return False
+
+    # The daemon runs in the background after the process above exits, wait until it accepts rpc requests
+    delay = 0.1
     while not is_torrent_daemon_running():
-        time.sleep(0.1)
-    return process.returncode == 0
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+    return True
 
 def add_torrent(torrent_link):
-    process = subprocess.Popen(["transmission-remote", "--add", torrent_link], stderr=subprocess.PIPE)
-    _, stderr = process.communicate()
-    if process.returncode != 0:
-        if not only_show_finished_notification:
-            show_notification("Download failed", "Failed to download torrent: {}, error: {}".format(torrent_link, stderr.decode('utf-8')), urgency="critical")
-    return process.returncode == 0
+    delay = torrent_add_retry_delay_sec
+    for attempt in range(torrent_add_retries + 1):
+        if attempt > 0:
+            time.sleep(delay)
+            delay *= 2
 
-def get_torrent_progress(tc):
-    torrent_progress = []
-    for torrent in tc.get_torrents():
-        torrent_progress.append(TorrentProgress(torrent.id, torrent.name, torrent.progress))
-    return torrent_progress
+        try:
+            with metrics.timer("automedia_torrent_add_seconds"):
+                torrent_rpc(lambda tc: tc.add_torrent(torrent_link))
+            metrics.inc("automedia_torrents_added_total")
+            return True
+        except (transmissionrpc.TransmissionError, OSError) as e:
+            # Older versions of transmission fail when the torrent has already been added
+            if "duplicate" in str(e):
+                return True
+            error = e
+
+    metrics.inc("automedia_torrent_add_failures_total")
+    print("{}: Failed to add torrent {}, error: {}".format(str(datetime.today().isoformat()), torrent_link, str(error)))
+    if not only_show_finished_notification:
+        show_notification("Download failed", "Failed to download torrent: {}, error: {}".format(torrent_link, str(error)), urgency="critical")
+    return False
+
+# Only the fields needed for TorrentProgress are requested, to keep polling cheap with a lot of torrents.
+# If @recently_active is True then only torrents that have been active in the last minute are returned
+# (transmissions "recently-active"), otherwise all torrents are returned.
+# Returns None if transmission couldn't be reached
+def get_torrent_progress(recently_active=False):
+    fields = ["id", "name", "percentDone"]
+    def get_torrents(tc):
+        if recently_active:
+            # transmissionrpc doesn't accept "recently-active" as ids, so it has to be passed directly in the request arguments
+            return list(tc._request("torrent-get", { "fields": fields, "ids": "recently-active" }).values())
+        return tc.get_torrents(arguments=fields)
 
-def get_finished_torrents(torrents):
-    filtered_torrents = []
-    for torrent in torrents:
-        if abs(100.0 - torrent.progress) <= 0.001:
-            filtered_torrents.append(torrent)
-    return filtered_torrents
+    try:
+        with metrics.timer("automedia_torrent_poll_seconds", recently_active=str(recently_active).lower()):
+            torrents = torrent_rpc(get_torrents)
+    except (transmissionrpc.TransmissionError, OSError) as e:
+        print("{}: Failed to get torrent progress, error: {}".format(str(datetime.today().isoformat()), str(e)))
+        return None
 
-def get_unfinished_torrents(torrents):
-    filtered_torrents = []
+    torrent_progress = []
     for torrent in torrents:
-        if abs(100.0 - torrent.progress) > 0.001:
-            filtered_torrents.append(torrent)
-    return filtered_torrents
-
-def get_matching_torrents_by_name(torrents1, torrents2):
-    matching_torrents = []
-    for torrent1 in torrents1:
-        for torrent2 in torrents2:
-            if torrent1.id == torrent2.id:
-                matching_torrents.append(torrent1.name)
-    return matching_torrents
-
-def get_html_items_progress(download_dir, tracked_html):
-    items = []
-    for html in tracked_html:
-        item_dir = os.path.join(download_dir, html.title)
-        try:
-            for item in os.listdir(item_dir):
-                finished = os.path.isfile(os.path.join(item_dir, item, ".finished"))
-                items.append(HtmlItemProgress(html.title + "/" + item, finished))
-        except FileNotFoundError:
-            pass
-    return items
+        torrent_progress.append(TorrentProgress(torrent.id, torrent.name, torrent.percentDone * 100.0))
+    return torrent_progress
 
-def get_matching_html_items_by_name(html_items1, html_items2):
-    matching_items = []
-    for html_item1 in html_items1:
-        for html_item2 in html_items2:
-            if html_item1.name == html_item2.name:
-                matching_items.append(html_item1.name)
-    return matching_items
+# Returns True if @torrent (a transmissionrpc torrent with the fields requested by remove_torrents_done_seeding)
+# has finished downloading and seeding
+def is_torrent_done_seeding(torrent, now):
+    if torrent.percentDone < 1.0:
+        return False
+    if torrent.uploadRatio >= torrent_seed_ratio:
+        return True
+    if torrent_max_seed_time_sec is None:
+        return False
+    # doneDate is 0 for torrents that were already downloaded when they were added
+    seeding_since = torrent.doneDate or torrent.addedDate
+    return seeding_since > 0 and now - seeding_since >= torrent_max_seed_time_sec
+
+# Remove the torrents that are done seeding (see is_torrent_done_seeding) from transmission. The downloaded files are not removed.
+# Returns the ids of the removed torrents, or None if transmission couldn't be reached
+def remove_torrents_done_seeding(now):
+    fields = ["id", "name", "percentDone", "uploadRatio", "doneDate", "addedDate"]
+    try:
+        with metrics.timer("automedia_torrent_removal_seconds"):
+            torrents = [torrent for torrent in torrent_rpc(lambda tc: tc.get_torrents(arguments=fields)) if is_torrent_done_seeding(torrent, now)]
+            if torrents:
+                torrent_rpc(lambda tc: tc.remove_torrent([torrent.id for torrent in torrents], delete_data=False))
+    except (transmissionrpc.TransmissionError, OSError) as e:
+        print("{}: Failed to remove torrents that are done seeding, error: {}".format(str(datetime.today().isoformat()), str(e)))
+        return None
 
-def add_rss(name, url, rss_config_dir, start_after):
-    feed = feedparser.parse(url)
+    for torrent in torrents:
+        print("{}: Removed torrent {} which is done seeding".format(str(datetime.today().isoformat()), torrent.name))
+    metrics.inc("automedia_torrents_removed_total", len(torrents))
+    return [torrent.id for torrent in torrents]
+
+def is_torrent_finished(torrent):
+    return abs(100.0 - torrent.progress) <= 0.001
+
+# Update @known_torrents (torrent id -> TorrentProgress) with @torrents and return the names of the torrents that were
+# unfinished in @known_torrents and are finished now.
+# If @all_torrents is True then @torrents contains all torrents and torrents that are not in it have been removed.
+def update_torrent_progress(known_torrents, torrents, all_torrents):
+    newly_finished_torrents = []
+    for torrent in torrents:
+        known_torrent = known_torrents.get(torrent.id)
+        if known_torrent and not is_torrent_finished(known_torrent) and is_torrent_finished(torrent):
+            newly_finished_torrents.append(torrent.name)
+        known_torrents[torrent.id] = torrent
+
+    if all_torrents:
+        torrent_ids = set(torrent.id for torrent in torrents)
+        for torrent_id in list(known_torrents.keys()):
+            if torrent_id not in torrent_ids:
+                del known_torrents[torrent_id]
+    return newly_finished_torrents
+
+# Fetches the rss and returns the item to add to @rss_config_dir (see write_tracked_items), or None if the rss can't be added
+def resolve_rss(name, url, rss_config_dir, start_after):
+    with get_host_semaphore(url):
+        host_rate_limiter.acquire(url)
+        feed = feedparser.parse(url)
     if feed.bozo == 1:
-        print("Failed to add rss, error: {}".format(str(feed.bozo_exception)))
-        return False
+        print("Failed to add rss {}, error: {}".format(url, str(feed.bozo_exception)))
+        return None
         
     if not name:
         name = feed["channel"]["title"].replace("/", "_").strip()
 
     if not name or len(name) == 0:
         print("Name not provided and name in rss is empty")
-        return False
+        return None
 
     start_after_url = None
     found_start_after = False
@@ -284,50 +940,24 @@ def add_rss(name, url, rss_config_dir, start_after):
     
     if start_after and not found_start_after:
         print("Failed to find %s in rss %s" % (start_after, url))
-        return False
-
-    name = name.replace("/", "_")
-    rss_dir = os.path.join(rss_config_dir, "tracked", name)
-    os.makedirs(rss_dir)
-
-    # Create an ".in_progress" file to prevent periodic sync from reading rss data
-    # before we have finished adding all the data.
-    # Timestamp is added to it to make it possible to automatically cleanup rss that is corrupted
-    # (for example if the computer crashes before the in_progress file is removed).
-    in_progress_filepath = os.path.join(rss_dir, ".in_progress")
-    with open(in_progress_filepath, "w") as file:
-        file.write(str(time.time()))
-
-    with open(os.path.join(rss_dir, "link"), "w") as file:
-        file.write(url)
-    
-    if start_after:
-        with open(os.path.join(rss_dir, "latest"), "w") as file:
-            file.write(start_after)
-
-    updated = str(time.time())
-    with open(os.path.join(rss_dir, "updated"), "w") as file:
-        file.write(updated)
+        return None
 
-    data = {
-        "link": url,
-        "updated": updated,
-        "downloaded": []
+    return {
+        "type": "rss",
+        "tracked_dir": os.path.join(rss_config_dir, "tracked"),
+        "name": name.replace("/", "_"),
+        "url": url,
+        "start_after": start_after,
+        "start_after_url": start_after_url
     }
-    if start_after:
-        data["downloaded"].append({ "title": start_after, "time": updated, "url": start_after_url })
-
-    with open(os.path.join(rss_dir, "data"), "w") as file:
-        json.dump(data, file, indent=4)
-    
-    os.remove(in_progress_filepath)
-    return True
 
-def add_html(name, url, html_config_dir, start_after):
+# Finds the plugin for the url (and lists the items if @start_after is set) and returns the item to add to @html_config_dir
+# (see write_tracked_items), or None if the html can't be added
+def resolve_html(name, url, html_config_dir, start_after):
     domain = url_extract_domain(url)
     if len(domain) == 0:
         print("Invalid url: {}".format(url))
-        return False
+        return None
     domain_plugin_path = os.path.join(script_dir, "plugins", domain)
     domain_plugin_py_path = os.path.join(script_dir, "plugins", domain + ".py")
 
@@ -338,11 +968,11 @@ def add_html(name, url, html_config_dir, start_after):
         plugin_path = domain_plugin_py_path
     else:
         print("Plugin doesn't exist: {}".format(domain))
-        return False
+        return None
 
     if not name or len(name) == 0:
         print("Name not provided or empty")
-        return False
+        return None
  
     start_after_url = None
     if start_after:
@@ -358,48 +988,191 @@ def add_html(name, url, html_config_dir, start_after):
             
             if not found_start_after:
                 print("Failed to find %s in html %s" % (start_after, url))
-                return False
+                return None
+
+    return {
+        "type": "html",
+        "tracked_dir": os.path.join(html_config_dir, "tracked"),
+        "name": name.replace("/", "_"),
+        "url": url,
+        "plugin": os.path.basename(plugin_path),
+        "start_after": start_after,
+        "start_after_url": start_after_url
+    }
 
-    name = name.replace("/", "_")
-    html_dir = os.path.join(html_config_dir, "tracked", name)
-    os.makedirs(html_dir)
+# Writes the tracked items returned by resolve_rss and resolve_html. Returns the number of items that were written.
+# An ".in_progress" file is created in every item directory before anything else is written, to prevent periodic sync
+# from reading the data before we have finished adding all the items.
+# Timestamp is added to it to make it possible to automatically cleanup items that are corrupted
+# (for example if the computer crashes before the in_progress file is removed).
+def write_tracked_items(items):
+    new_items = []
+    for item in items:
+        if os.path.exists(os.path.join(item["tracked_dir"], item["name"])):
+            print("{} {} is already tracked".format(item["type"], item["name"]))
+        else:
+            new_items.append(item)
 
-    # Create an ".in_progress" file to prevent periodic sync from reading rss data
-    # before we have finished adding all the data.
-    # Timestamp is added to it to make it possible to automatically cleanup rss that is corrupted
-    # (for example if the computer crashes before the in_progress file is removed).
-    in_progress_filepath = os.path.join(html_dir, ".in_progress")
-    with open(in_progress_filepath, "w") as file:
-        file.write(str(int(time.time())))
+    # Remove the state of previously tracked items with the same name, the state is imported from the data file by sync.
+    # This is done before any directory is created, so nothing is left half-added if the database can't be written
+    if new_items and open_state_db():
+        try:
+            for item in new_items:
+                state_db.remove_tracked(item["type"], item["name"])
+        except sqlite3.Error as e:
+            print("Failed to update {}, error: {}".format(state_db_path, str(e)))
+            return 0
+
+    created_items = []
+    for item in new_items:
+        item_dir = os.path.join(item["tracked_dir"], item["name"])
+        try:
+            os.makedirs(item_dir)
+        except FileExistsError:
+            print("{} {} is already tracked".format(item["type"], item["name"]))
+            continue
 
-    with open(os.path.join(html_dir, "link"), "w") as file:
-        file.write(url)
+        with open(os.path.join(item_dir, ".in_progress"), "w") as file:
+            file.write(str(time.time()))
+        created_items.append((item, item_dir))
 
-    with open(os.path.join(html_dir, "plugin"), "w") as file:
-        file.write(os.path.basename(plugin_path))
+    if state_db:
+        updated = str(time.time())
+    else:
+        updated = downloaded_index_append([(item["type"], item["name"], item["start_after"]) for item, _ in created_items if item["start_after"]])
+
+    for item, item_dir in created_items:
+        with open(os.path.join(item_dir, "link"), "w") as file:
+            file.write(item["url"])
+
+        data = {}
+        if item["type"] == "html":
+            with open(os.path.join(item_dir, "plugin"), "w") as file:
+                file.write(item["plugin"])
+            data["plugin"] = item["plugin"]
     
-    if start_after:
-        with open(os.path.join(html_dir, "latest"), "w") as file:
-            file.write(start_after)
+        if item["start_after"]:
+            with open(os.path.join(item_dir, "latest"), "w") as file:
+                file.write(item["start_after"])
 
-    updated = str(time.time())
-    with open(os.path.join(html_dir, "updated"), "w") as file:
-        file.write(updated)
+        with open(os.path.join(item_dir, "updated"), "w") as file:
+            file.write(updated)
 
-    data = {
-        "plugin": os.path.basename(plugin_path),
-        "link": url,
-        "updated": updated,
-        "downloaded": []
-    }
-    if start_after:
-        data["downloaded"].append({ "title": start_after, "time": updated, "url": start_after_url })
+        data["link"] = item["url"]
+        data["updated"] = updated
+        data["downloaded"] = []
+        if item["start_after"]:
+            data["downloaded"].append({ "title": item["start_after"], "time": updated, "url": item["start_after_url"] })
 
-    with open(os.path.join(html_dir, "data"), "w") as file:
-        json.dump(data, file, indent=4)
-    
-    os.remove(in_progress_filepath)
-    return True
+        with open(os.path.join(item_dir, "data"), "w") as file:
+            json.dump(data, file, indent=4)
+
+    for _, item_dir in created_items:
+        os.remove(os.path.join(item_dir, ".in_progress"))
+    return len(created_items)
+
+def add_rss(name, url, rss_config_dir, start_after):
+    item = resolve_rss(name, url, rss_config_dir, start_after)
+    return item is not None and write_tracked_items([item]) == 1
+
+def add_html(name, url, html_config_dir, start_after):
+    item = resolve_html(name, url, html_config_dir, start_after)
+    return item is not None and write_tracked_items([item]) == 1
+
+# Returns the keys of an item to add from a json @entry, or None if @entry isn't an object or any of the keys isn't a string
+def get_json_add_entry(entry):
+    if not isinstance(entry, dict):
+        return None
+    add_entry = { key: entry.get(key) for key in ("type", "url", "name", "start_after") }
+    for value in add_entry.values():
+        if value is not None and not isinstance(value, str):
+            return None
+    return add_entry
+
+# Returns a tuple of (entries, number of invalid entries) where entries is a list of { "type": ..., "url": ..., "name": ..., "start_after": ... }
+# from a json, csv or opml file. Json files should have a list of objects with those keys, csv files should have a header row
+# with those columns and opml files should have outlines with either "xmlUrl" (rss) or "htmlUrl" (html) attributes.
+# "name" and "start_after" are optional (except that html requires a name). Invalid entries are reported and skipped
+def read_add_file(filepath):
+    with open(filepath, "rb") as file:
+        content = file.read()
+
+    extension = os.path.splitext(filepath)[1].lower()
+    stripped_content = content.lstrip()
+    if extension == ".json" or stripped_content.startswith(b"["):
+        json_entries = json.loads(content.decode("utf-8"))
+        if not isinstance(json_entries, list):
+            raise ValueError("Expected a list of items in {}".format(filepath))
+        entries = []
+        num_invalid = 0
+        for index, json_entry in enumerate(json_entries):
+            entry = get_json_add_entry(json_entry)
+            if entry:
+                entries.append(entry)
+            else:
+                print("Skipping item {} in {}, expected an object where type, url, name and start_after are strings".format(index + 1, filepath))
+                num_invalid += 1
+        return entries, num_invalid
+    elif extension in (".opml", ".xml") or stripped_content.startswith(b"<"):
+        entries = []
+        for outline in etree.fromstring(content).iter("outline"):
+            name = outline.get("title") or outline.get("text")
+            if outline.get("xmlUrl"):
+                entries.append({ "type": "rss", "url": outline.get("xmlUrl"), "name": name, "start_after": outline.get("startAfter") })
+            elif outline.get("htmlUrl"):
+                entries.append({ "type": "html", "url": outline.get("htmlUrl"), "name": name, "start_after": outline.get("startAfter") })
+        return entries, 0
+    else:
+        entries = []
+        for row in csv.DictReader(io.StringIO(content.decode("utf-8"))):
+            entries.append({ key: (row.get(key) or "").strip() or None for key in ("type", "url", "name", "start_after") })
+        return entries, 0
+
+# Add all media in @filepath (see read_add_file). The rss and html of all media are fetched concurrently
+# and the media that could be added are then written together. Returns True if all media were added
+def add_from_file(filepath):
+    try:
+        entries, num_invalid = read_add_file(filepath)
+    except (OSError, ValueError, etree.XMLSyntaxError, csv.Error) as e:
+        print("Failed to read {}, error: {}".format(filepath, str(e)))
+        return False
+
+    os.makedirs(rss_config_dir, exist_ok=True)
+    os.makedirs(html_config_dir, exist_ok=True)
+
+    def resolve_entry(entry):
+        start_after = entry["start_after"].replace("/", "_").strip() if entry["start_after"] else None
+        if entry["type"] == "rss":
+            return resolve_rss(entry["name"], entry["url"], rss_config_dir, start_after)
+        elif entry["type"] == "html":
+            return resolve_html(entry["name"], entry["url"], html_config_dir, start_after)
+        print("Invalid type {} for url {}, type should be either rss or html".format(entry["type"], entry["url"]))
+        return None
+
+    valid_entries = []
+    for entry in entries:
+        if not entry["url"]:
+            print("Missing url for {}".format(entry["name"] or "item"))
+        else:
+            valid_entries.append(entry)
+
+    with ThreadPoolExecutor(max_workers=rss_fetch_workers) as executor:
+        resolved_items = list(executor.map(resolve_entry, valid_entries))
+
+    items = []
+    names = set()
+    for item in resolved_items:
+        if not item:
+            continue
+        if (item["type"], item["name"]) in names:
+            print("{} {} is in the file more than once".format(item["type"], item["name"]))
+            continue
+        names.add((item["type"], item["name"]))
+        items.append(item)
+
+    num_added = write_tracked_items(items)
+    print("Added {} of {} media".format(num_added, len(entries) + num_invalid))
+    return num_added == len(entries) + num_invalid
 
 def get_downloaded_item_by_title(tracked_rss, title):
     for item in tracked_rss.json_data["downloaded"]:
@@ -407,61 +1180,337 @@ def get_downloaded_item_by_title(tracked_rss, title):
             return item
     return None
 
-# Return the title of the newest item
-def sync_rss(tracked_rss):
+def get_xml_name(element):
+    return etree.QName(element).localname
+
+# Returns the link of an rss item or atom entry
+def get_rss_item_link(item_element):
+    for child in item_element:
+        if get_xml_name(child) != "link":
+            continue
+        if child.get("href") is None:
+            return (child.text or "").strip()
+        if child.get("rel", "alternate") == "alternate":
+            return child.get("href")
+    return ""
+
+# Parse the rss or atom feed in the http @response while it's being downloaded, and stop downloading
+# at the first item that is in @seen (a SeenIndex). The returned feed has the same fields as the feeds from feedparser
+# that are used by automedia, with the items up to and including the first seen item.
+# Feeds that are not valid xml are parsed with feedparser instead
+def parse_rss_stream(response, seen):
+    feed = feedparser.FeedParserDict(bozo=0, items=[], feed=feedparser.FeedParserDict(links=[]))
+    data = bytearray()
+    chunks = response.iter_content(chunk_size=16 * 1024)
+    parser = etree.XMLPullParser(events=("start", "end"))
+    try:
+        for chunk in chunks:
+            data += chunk
+            metrics.inc("automedia_rss_downloaded_bytes_total", len(chunk))
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                name = get_xml_name(element)
+                if event == "start":
+                    if element.getparent() is None and name not in ("rss", "RDF", "feed"):
+                        raise etree.XMLSyntaxError("Not an rss or atom feed", 0, 0, 0)
+                    continue
+
+                if name in ("item", "entry"):
+                    title = ""
+                    for child in element:
+                        if get_xml_name(child) == "title":
+                            title = "".join(child.itertext()).strip()
+                            break
+                    link = get_rss_item_link(element)
+                    element.clear()
+                    feed["items"].append(feedparser.FeedParserDict(title=title, link=link))
+                    if seen.contains(title.replace("/", "_"), link):
+                        return feed
+                elif name == "link" and element.get("href") and element.get("rel") and get_xml_name(element.getparent()) in ("feed", "channel"):
+                    feed["feed"]["links"].append(feedparser.FeedParserDict(rel=element.get("rel"), href=element.get("href")))
+        parser.close()
+    except etree.XMLSyntaxError:
+        for chunk in chunks:
+            data += chunk
+            metrics.inc("automedia_rss_downloaded_bytes_total", len(chunk))
+        metrics.inc("automedia_rss_parser_fallbacks_total")
+        return feedparser.parse(bytes(data), response_headers=response.headers)
+    return feed
+
+# If @http_cache is provided then the feed is only downloaded if it has changed since then,
+# otherwise the returned feed has status 304 and no items.
+# If @seen (a SeenIndex) is provided then the feed can stop being downloaded at the first item in @seen,
+# so the returned feed might not have all items
+def fetch_rss(url, http_cache=None, seen=None):
+    if not http_cache:
+        http_cache = {}
+    with get_host_semaphore(url):
+        host_rate_limiter.acquire(url)
+        if not use_streaming_rss_parser or seen is None:
+            with metrics.timer("automedia_rss_fetch_seconds", parser="feedparser"):
+                return feedparser.parse(url, etag=http_cache.get("etag"), modified=http_cache.get("modified"))
+
+        headers = {}
+        if http_cache.get("etag"):
+            headers["If-None-Match"] = http_cache["etag"]
+        if http_cache.get("modified"):
+            headers["If-Modified-Since"] = http_cache["modified"]
+        try:
+            with metrics.timer("automedia_rss_fetch_seconds", parser="stream"), rss_http_session.get(url, headers=headers, stream=True, timeout=rss_fetch_timeout_sec) as response:
+                if response.status_code == 304:
+                    feed = feedparser.FeedParserDict(bozo=0, items=[], feed=feedparser.FeedParserDict(links=[]))
+                elif response.status_code != 200:
+                    feed = feedparser.FeedParserDict(bozo=1, bozo_exception=Exception("Server responded with status code {}".format(response.status_code)), items=[], feed={})
+                else:
+                    feed = parse_rss_stream(response, seen)
+                feed["status"] = response.status_code
+                feed["etag"] = response.headers.get("ETag")
+                feed["modified"] = response.headers.get("Last-Modified")
+                return feed
+        except requests.RequestException as e:
+            return feedparser.FeedParserDict(bozo=1, bozo_exception=e, items=[], feed={})
+
+def fetch_tracked_rss_feed(tracked_rss):
     rss_tracked_dir = os.path.join(rss_config_dir, "tracked")
-    feed = feedparser.parse(tracked_rss.link)
+    return fetch_rss(tracked_rss.link, get_http_cache(os.path.join(rss_tracked_dir, tracked_rss.title)), tracked_rss.seen)
+
+# Returns the url of the page after page @page_number (starting from 1) of the feed with the url @url, where @feed is that page.
+# Atom feeds link to the next page, nyaa.si feeds have the page number in the "p" query parameter.
+# Returns None if the feed doesn't have more pages
+def get_rss_next_page_url(url, feed, page_number):
+    for link in feed.get("feed", {}).get("links", []):
+        if link.get("rel") == "next" and link.get("href"):
+            return link["href"]
+
+    if url_extract_domain(url) == "nyaa":
+        split_url = urllib.parse.urlsplit(url)
+        query = [(key, value) for key, value in urllib.parse.parse_qsl(split_url.query, keep_blank_values=True) if key != "p"]
+        query.append(("p", str(page_number + 1)))
+        return urllib.parse.urlunsplit(split_url._replace(query=urllib.parse.urlencode(query)))
+    return None
+
+# Yields the items of @feed (the first page of the feed) and then the items of the following pages.
+# A page is only fetched when all items of the previous page have been consumed, so stopping the iteration early
+# doesn't fetch any more pages
+def iterate_rss_pages(tracked_rss, feed):
+    page_number = 1
+    fetched_urls = set([tracked_rss.link])
+    while True:
+        for item in feed["items"]:
+            yield item
+
+        if not feed["items"] or page_number >= rss_max_pages:
+            return
+
+        next_page_url = get_rss_next_page_url(tracked_rss.link, feed, page_number)
+        if not next_page_url or next_page_url in fetched_urls:
+            return
+        fetched_urls.add(next_page_url)
+
+        feed = fetch_rss(next_page_url, seen=tracked_rss.seen)
+        if feed.bozo == 1:
+            print("{}: Failed to fetch page {} of rss for url {}, error: {}".format(str(datetime.today().isoformat()), page_number + 1, tracked_rss.link, str(feed.bozo_exception)))
+            return
+        page_number += 1
+
+# Returns the items in @feed that haven't been downloaded yet, from the oldest to the newest.
+# If none of the items on the first page of the feed have been downloaded, the next pages are checked as well.
+# Returns None if the feed failed to parse or hasn't changed since the last sync
+def get_new_rss_items(tracked_rss, feed):
+    rss_tracked_dir = os.path.join(rss_config_dir, "tracked")
+    # The feed hasn't changed since the last time it was synced
+    if feed.get("status") == 304:
+        metrics.inc("automedia_not_modified_total", type="rss")
+        return None
     if feed.bozo == 1:
         print("{}: Failed to sync rss for url {}, error: {}".format(str(datetime.today().isoformat()), tracked_rss.link, str(feed.bozo_exception)))
         if not only_show_finished_notification:
             show_notification("RSS Sync failed", "Failed to parse rss for url {}, error: {}".format(tracked_rss.link, str(feed.bozo_exception)), urgency="critical")
         return None
 
-    seen_titles = set()
-    seen_urls = set()
-    for downloaded_item in tracked_rss.json_data["downloaded"]:
-        seen_titles.add(downloaded_item["title"].lower().replace(" ", ""))
-        seen_urls.add(downloaded_item.get("url", ""))
-
+    # Without any downloaded items all items of the feed would be new, so only the first page is used
+    feed_items = iterate_rss_pages(tracked_rss, feed) if tracked_rss.json_data["downloaded"] else feed["items"]
     items = []
-    for item in feed["items"]:
+    # Items can move to the next page while the pages are being fetched, which would otherwise add them twice
+    item_links = set()
+    found_seen_item = False
+    for item in feed_items:
         title = item["title"].replace("/", "_").strip()
         link = item["link"]
-        # TODO: Goto next page in rss if supported, if we cant find our item on the first page
-        #if not get_downloaded_item_by_title(tracked_rss, title):
-        if title.lower().replace(" ", "") in seen_titles or link in seen_urls:
+        if tracked_rss.seen.contains(title, link):
+            found_seen_item = True
             break
+        if link in item_links:
+            continue
+        item_links.add(link)
         items.append(item)
 
-    # Add torrents from the oldest to the newest, and stop when failing to add torrent.
-    # If it fails, there will be an attempt to add them again after next sync cycle.
+    # If the last downloaded item isn't in any of the pages (for example if the titles in the feed have changed)
+    # then only the items of the first page are added, instead of everything in the feed
+    if not found_seen_item and len(items) > len(feed["items"]):
+        print("{}: rss: The last downloaded item of {} was not found in the feed, only adding the items of the first page".format(str(datetime.today().isoformat()), tracked_rss.title))
+        items = items[:len(feed["items"])]
+    items.reverse()
+    metrics.inc("automedia_new_items_total", len(items), type="rss")
+
+    if not items:
+        set_http_cache(os.path.join(rss_tracked_dir, tracked_rss.title), feed.get("etag"), feed.get("modified"))
+    return items
+
+# Add torrents from the oldest to the newest, and stop when failing to add torrent.
+# If it fails, there will be an attempt to add them again after next sync cycle.
+# Return the title of the newest item that was added
+def add_rss_items(tracked_rss, feed, items):
+    rss_tracked_dir = os.path.join(rss_config_dir, "tracked")
     latest = None
-    for item in reversed(items):
+    for item in items:
         title = item["title"].replace("/", "_").strip()
         link = item["link"]
-        rss_update_latest(rss_tracked_dir, tracked_rss, title, link)
-
         if not add_torrent(link):
             return latest
+
+        with metrics.timer("automedia_state_write_seconds", type="rss"):
+            rss_update_latest(rss_tracked_dir, tracked_rss, title, link)
         latest = title
         if not only_show_finished_notification:
             show_notification("Download started", latest)
+
+    # Only remember the validators when all items have been added, otherwise the failed items
+    # would not be retried until the feed changes again
+    set_http_cache(os.path.join(rss_tracked_dir, tracked_rss.title), feed.get("etag"), feed.get("modified"))
     return latest
 
-def plugin_list(plugin_path, url, latest):
-    if not latest:
-        latest = []
+# Return the title of the newest item
+def sync_rss(tracked_rss, feed=None):
+    if feed is None:
+        feed = fetch_tracked_rss_feed(tracked_rss)
+    items = get_new_rss_items(tracked_rss, feed)
+    if not items:
+        return None
+    return add_rss_items(tracked_rss, feed, items)
 
-    plugin_name = os.path.basename(plugin_path)
-    process = None
+# Returns True if @path is a python file with a python_plugin_marker line. The plugin is loaded (and its code is run)
+# only if it has the marker, since plugins that only support being run as a program may run their command line interface when loaded
+def is_in_process_plugin(path):
     try:
-        process = subprocess.Popen([plugin_path, "list", url], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    except FileNotFoundError as e:
-        print("{}: Plugin failed: Failed to launch plugin list for plugin {}, error: {}".format(str(datetime.today().isoformat()), plugin_name, str(e)))
+        with open(path, "r", encoding="utf-8", errors="replace") as file:
+            lines = file.read().splitlines()
+    except OSError:
+        return False
+
+    if not lines or (not path.endswith(".py") and not (lines[0].startswith("#!") and "python" in lines[0])):
+        return False
+    return any(line.strip() == python_plugin_marker for line in lines)
+
+# Returns the plugin module if the plugin is a python file that has a python_plugin_marker line
+# and list_chapters and download_chapter functions, which can be called directly:
+#   list_chapters(url, downloaded, http_cache_filepath, session) -> [{ "name": "...", "url": "..." }, ...]
+#   download_chapter(url, download_dir, session)
+# where @downloaded is the same as the input to the "list" command and @session is a requests session shared by all plugins.
+# Plugins that set supports_list_fingerprint = True in the module get the list input with a fingerprint (see build_plugin_list_input).
+# The functions should raise an exception on failure.
+# The plugin is only loaded once (plugins that are symlinks to the same file share the module).
+# Returns None if python plugins are disabled or if the plugin can't be used in-process
+def get_python_plugin(plugin_path):
+    global plugin_http_session
+    if not use_python_plugins:
+        return None
+
+    plugin_real_path = os.path.realpath(plugin_path)
+    with python_plugins_lock:
+        if plugin_real_path in python_plugins:
+            return python_plugins[plugin_real_path]
+
+        plugin_module = None
+        if is_in_process_plugin(plugin_real_path):
+            module_name = "automedia_plugin_" + os.path.basename(plugin_real_path).replace(".", "_")
+            loader = importlib.machinery.SourceFileLoader(module_name, plugin_real_path)
+            module = importlib.util.module_from_spec(importlib.util.spec_from_loader(module_name, loader))
+            try:
+                loader.exec_module(module)
+                if callable(getattr(module, "list_chapters", None)) and callable(getattr(module, "download_chapter", None)):
+                    plugin_module = module
+            # Plugins that have the marker but still run their command line interface when they are loaded exit
+            except (Exception, SystemExit) as e:
+                print("{}: Failed to load plugin {} in-process, running it as a separate process instead. Error: {}".format(str(datetime.today().isoformat()), plugin_path, str(e)))
+
+        if plugin_module and not plugin_http_session:
+            plugin_http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16)
+            plugin_http_session.mount("http://", adapter)
+            plugin_http_session.mount("https://", adapter)
+
+        python_plugins[plugin_real_path] = plugin_module
+        return plugin_module
+
+# Returns the worker for the plugin, which is started the first time and restarted if it has exited.
+# Returns None if plugin workers are disabled or if the plugin doesn't support worker mode
+def get_plugin_worker(plugin_path):
+    if not use_plugin_workers:
         return None
 
-    stdout, stderr = process.communicate(json.dumps(latest).encode())
+    plugin_name = os.path.basename(plugin_path)
+    with plugin_workers_lock:
+        if plugin_name in plugin_workers:
+            plugin_worker = plugin_workers[plugin_name]
+            if not plugin_worker or plugin_worker.is_running():
+                return plugin_worker
+        plugin_worker = PluginWorker.start(plugin_path)
+        plugin_workers[plugin_name] = plugin_worker
+        return plugin_worker
+
+# The downloaded items of @tracked_html (None when adding) are sent to the plugin (see build_plugin_list_input).
+# If @http_cache_filepath is provided then the plugin uses the http validators in that file to only download
+# the list if it has changed, and updates the file with the new validators
+def plugin_list(plugin_path, url, tracked_html, http_cache_filepath=None):
+    plugin_name = os.path.basename(plugin_path)
+    # Plugins make the rest of their requests (for example for images) themselves, so only the page of the command is rate limited.
+    # This is the same for every way of running the plugin
+    host_rate_limiter.acquire(url)
+    python_plugin = get_python_plugin(plugin_path)
+    if python_plugin:
+        with get_plugin_semaphore(plugin_path):
+            try:
+                with metrics.timer("automedia_plugin_seconds", plugin=plugin_name, command="list", mode="python"):
+                    list_input = build_plugin_list_input(tracked_html, getattr(python_plugin, "supports_list_fingerprint", False) is True)
+                    return python_plugin.list_chapters(url, list_input, http_cache_filepath, plugin_http_session)
+            except Exception as e:
+                metrics.inc("automedia_plugin_failures_total", plugin=plugin_name, command="list")
+                print("{}: Plugin failed: Failed to list with plugin {} and url {}, error: {}".format(str(datetime.today().isoformat()), plugin_name, url, str(e)))
+                if not only_show_finished_notification:
+                    show_notification("Plugin failed", "Failed to list with plugin {} and url {}, error: {}".format(plugin_name, url, str(e)), urgency="critical")
+                return None
+
+    plugin_worker = get_plugin_worker(plugin_path)
+    if plugin_worker:
+        with get_plugin_semaphore(plugin_path):
+            try:
+                with metrics.timer("automedia_plugin_seconds", plugin=plugin_name, command="list", mode="worker"):
+                    list_input = build_plugin_list_input(tracked_html, plugin_worker.supports_list_fingerprint)
+                    return plugin_worker.request({ "command": "list", "url": url, "downloaded": list_input, "http_cache": http_cache_filepath })
+            except PluginWorkerError as e:
+                metrics.inc("automedia_plugin_failures_total", plugin=plugin_name, command="list")
+                print("{}: Plugin failed: Failed to list with plugin worker {} and url {}, error: {}".format(str(datetime.today().isoformat()), plugin_name, url, str(e)))
+                if not only_show_finished_notification:
+                    show_notification("Plugin failed", "Failed to list with plugin worker {} and url {}, error: {}".format(plugin_name, url, str(e)), urgency="critical")
+                return None
+
+    # The http cache file is passed in an environment variable, since the arguments after the url are reserved for plugins (see sync_html)
+    env = None
+    if http_cache_filepath:
+        env = dict(os.environ, AUTOMEDIA_HTTP_CACHE=http_cache_filepath)
+    with get_plugin_semaphore(plugin_path):
+        process = None
+        try:
+            process = subprocess.Popen([plugin_path, "list", url], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, env=env)
+        except FileNotFoundError as e:
+            print("{}: Plugin failed: Failed to launch plugin list for plugin {}, error: {}".format(str(datetime.today().isoformat()), plugin_name, str(e)))
+            return None
+
+        with metrics.timer("automedia_plugin_seconds", plugin=plugin_name, command="list", mode="process"):
+            stdout, stderr = process.communicate(json.dumps(build_plugin_list_input(tracked_html, False)).encode())
     if process.returncode != 0:
+        metrics.inc("automedia_plugin_failures_total", plugin=plugin_name, command="list")
         print("{}: Plugin failed: Failed to launch plugin list for plugin {} and url {}, error: stdout: {}, stderr: {}".format(str(datetime.today().isoformat()), plugin_name, url, stdout.decode('utf-8'), stderr.decode('utf-8')))
         if not only_show_finished_notification:
             show_notification("Plugin failed", "Failed to launch plugin list for plugin {} and url {}, error: stdout: {}, stderr: {}".format(plugin_name, url, stdout.decode('utf-8'), stderr.decode('utf-8')), urgency="critical")
@@ -475,55 +1524,151 @@ def plugin_list(plugin_path, url, latest):
         return None
 
 def plugin_download(plugin_path, url, download_dir):
-    process = subprocess.Popen([plugin_path, "download", url, download_dir], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.communicate()
-    return process.returncode == 0
+    plugin_name = os.path.basename(plugin_path)
+    # Only the chapter page is rate limited, see plugin_list
+    host_rate_limiter.acquire(url)
+    python_plugin = get_python_plugin(plugin_path)
+    if python_plugin:
+        with get_plugin_semaphore(plugin_path):
+            try:
+                with metrics.timer("automedia_plugin_seconds", plugin=plugin_name, command="download", mode="python"):
+                    python_plugin.download_chapter(url, download_dir, plugin_http_session)
+                return True
+            except Exception as e:
+                metrics.inc("automedia_plugin_failures_total", plugin=plugin_name, command="download")
+                print("{}: Plugin failed: Failed to download with plugin {} and url {}, error: {}".format(str(datetime.today().isoformat()), plugin_name, url, str(e)))
+                return False
 
-def resume_tracked_html(plugin_entry, download_dir, tracked_html, session_id):
-    # TODO: Instead of redownloading, add resuming. This could be done by adding the files that have been downloaded to a file.
-    # Redownload items we can detect have stopped. This can happen if the computer crashes or loses connection while downloading.
+    plugin_worker = get_plugin_worker(plugin_path)
+    if plugin_worker:
+        with get_plugin_semaphore(plugin_path):
+            try:
+                with metrics.timer("automedia_plugin_seconds", plugin=plugin_name, command="download", mode="worker"):
+                    plugin_worker.request({ "command": "download", "url": url, "download_dir": download_dir })
+                return True
+            except PluginWorkerError as e:
+                metrics.inc("automedia_plugin_failures_total", plugin=plugin_name, command="download")
+                print("{}: Plugin failed: Failed to download with plugin worker {} and url {}, error: {}".format(str(datetime.today().isoformat()), plugin_name, url, str(e)))
+                return False
+
+    with get_plugin_semaphore(plugin_path):
+        with metrics.timer("automedia_plugin_seconds", plugin=plugin_name, command="download", mode="process"):
+            process = subprocess.Popen([plugin_path, "download", url, download_dir], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            process.communicate()
+        if process.returncode != 0:
+            metrics.inc("automedia_plugin_failures_total", plugin=plugin_name, command="download")
+        return process.returncode == 0
+
+# Returns the number of seconds since the ".in_progress" file at @in_progress_path was created, from the timestamp in the file
+# or the modification time of the file if it doesn't have a timestamp. Returns None if the file doesn't exist
+def get_in_progress_age(in_progress_path, now):
+    try:
+        with open(in_progress_path, "r") as file:
+            started = parse_timestamp_or_none(file.read())
+        if started is None:
+            started = os.path.getmtime(in_progress_path)
+    except FileNotFoundError:
+        return None
+    return now - started
+
+# Remove the tracked items in @tracked_dir that were not finished being added within in_progress_timeout_sec,
+# so they are not skipped by every sync. Returns the number of removed items
+def remove_stale_tracked_items(tracked_dir, media_type, now):
+    try:
+        titles = os.listdir(tracked_dir)
+    except FileNotFoundError:
+        return 0
+
+    num_removed = 0
+    for title in titles:
+        age = get_in_progress_age(os.path.join(tracked_dir, title, ".in_progress"), now)
+        if age is None or age < in_progress_timeout_sec:
+            continue
+
+        print("{}: {}: Removing {} which was not finished being added".format(str(datetime.today().isoformat()), media_type, title))
+        shutil.rmtree(os.path.join(tracked_dir, title), ignore_errors=True)
+        if state_db:
+            state_db.remove_tracked(media_type, title)
+        num_removed += 1
+    return num_removed
+
+# Returns (item name, item directory, url) of the downloads of @tracked_html that have stopped. This can happen if the computer crashes
+# or loses connection while downloading, or if the plugin fails. Downloads are stopped if they were started by a previous sync
+# (with another @session_id), or if they are not running and were started more than in_progress_timeout_sec ago
+def get_stalled_downloads(download_dir, tracked_html, session_id, now):
     title_dir = os.path.join(download_dir, tracked_html.title)
     try:
-        for item in os.listdir(title_dir):
-            item_dir = os.path.join(title_dir, item)
-            if os.path.isfile(os.path.join(item_dir, ".finished")):
-                continue
-            
-            in_progress_path = os.path.join(item_dir, ".in_progress")
-            url = get_file_content_or_none(in_progress_path)
-            # Item has finished downloading
-            if not url:
+        items = os.listdir(title_dir)
+    except FileNotFoundError:
+        return []
+
+    stalled_downloads = []
+    for item in items:
+        item_dir = os.path.join(title_dir, item)
+        in_progress_path = os.path.join(item_dir, ".in_progress")
+        url = get_file_content_or_none(in_progress_path)
+        # Item has finished downloading
+        if not url or os.path.isfile(os.path.join(item_dir, ".finished")):
+            continue
+
+        item_name = os.path.join(tracked_html.title, item)
+        if html_download_watcher.is_active(item_name):
+            continue
+
+        if get_file_content_or_none(os.path.join(item_dir, ".session_id")) == session_id:
+            age = get_in_progress_age(in_progress_path, now)
+            if age is None or age < in_progress_timeout_sec:
                 continue
+        stalled_downloads.append((item_name, item_dir, url))
+    return stalled_downloads
 
-            invalid_session = False
-            try:
-                with open(os.path.join(item_dir, ".session_id"), "r") as file:
-                    item_session_id = file.read()
-                    if item_session_id != session_id:
-                        invalid_session = True
-            except FileNotFoundError as e:
-                invalid_session = True
-            
-            if invalid_session:
-                #if not only_show_finished_notification:
-                show_notification("Resuming", "Resuming download for item {} with plugin {}".format(os.path.join(tracked_html.title, item), tracked_html.plugin))
-                with open(os.path.join(item_dir, ".session_id"), "w") as file:
-                    file.write(session_id)
-                plugin_download(plugin_entry, url, item_dir)
-
-    except FileNotFoundError as e:
-        pass
+def resume_tracked_html(plugin_entry, download_dir, tracked_html, session_id):
+    # Resume downloading items we can detect have stopped (see get_stalled_downloads).
+    # The download is started again with the same download directory, and plugins that keep a manifest of the files
+    # they have downloaded (".manifest") only download the missing files.
+    for item_name, item_dir, url in get_stalled_downloads(download_dir, tracked_html, session_id, time.time()):
+        #if not only_show_finished_notification:
+        show_notification("Resuming", "Resuming download for item {} with plugin {}".format(item_name, tracked_html.plugin))
+        with open(os.path.join(item_dir, ".session_id"), "w") as file:
+            file.write(session_id)
+        html_download_watcher.add(item_name, item_dir)
+        if not plugin_download(plugin_entry, url, item_dir):
+            html_download_watcher.remove(item_name)
 
-def build_plugin_list_input(tracked_html):
-    result = []
-    for downloaded_item in tracked_html.json_data["downloaded"]:
-        result.append({ "title": downloaded_item["title"], "url": downloaded_item.get("url", "") })
-    return result
+# Returns the downloaded items of @tracked_html in the format of the input of the plugin "list" command (see sync_html).
+# If @use_fingerprint is True then only the latest plugin_list_input_window items are sent as they are, and the
+# plugin_list_fingerprint_size items before them are sent as hashes. Otherwise all items are sent as they are
+def build_plugin_list_input(tracked_html, use_fingerprint):
+    if not tracked_html:
+        return []
+
+    downloaded_items = tracked_html.json_data["downloaded"]
+    if use_fingerprint:
+        downloaded_items = downloaded_items[-plugin_list_input_window:]
+    downloaded = []
+    for downloaded_item in downloaded_items:
+        downloaded.append({ "title": downloaded_item["title"], "url": downloaded_item.get("url", "") })
+
+    older_hashes = tracked_html.seen.hashes[:-plugin_list_input_window][-plugin_list_fingerprint_size:]
+    if not use_fingerprint or not older_hashes:
+        return downloaded
+
+    return {
+        "downloaded": downloaded,
+        "fingerprint": {
+            "hash_length": plugin_list_input_hash_length,
+            "titles": [title_hash for title_hash, _ in older_hashes],
+            "urls": [url_hash for _, url_hash in older_hashes if url_hash]
+        }
+    }
 
 # Return the title of the newest item
 def sync_html(tracked_html, download_dir, session_id):
     plugin_entry = os.path.join(script_dir, "plugins", tracked_html.plugin)
-    resume_tracked_html(plugin_entry, download_dir, tracked_html, session_id)
+    # Stopped downloads are found by sync (see get_stalled_downloads), instead of checking the download directory every time
+    if tracked_html.resume_pending:
+        tracked_html.resume_pending = False
+        resume_tracked_html(plugin_entry, download_dir, tracked_html, session_id)
     html_tracked_dir = os.path.join(html_config_dir, "tracked")
 
     # The program takes and index starting from 1, which is the chapter number
@@ -543,13 +1688,36 @@ def sync_html(tracked_html, download_dir, session_id):
     #   ]
     # ./program list url latest
     # Note: @latest argument here is optional
-    items = plugin_list(plugin_entry, tracked_html.link, build_plugin_list_input(tracked_html))
+    # The items that have already been downloaded are written to the programs stdin, as a json list of { "title": "...", "url": "..." }.
+    # Plugins that support it (see PluginWorker and get_python_plugin) instead get a json object for tracked items with a long history,
+    # where "downloaded" is that list with only the latest items and "fingerprint" has the truncated sha1 hashes
+    # ("hash_length" hex characters) of the older items:
+    #   {
+    #     "downloaded": [{ "title": "Example name", "url": "https://example.com" }],
+    #     "fingerprint": { "hash_length": 12, "titles": ["0123456789ab"], "urls": ["ba9876543210"] }
+    #   }
+    # The titles are hashed after they have been lowercased and had their spaces removed.
+    # If the AUTOMEDIA_HTTP_CACHE environment variable is set (to the path of a file) then the program should
+    # send a conditional request using the validators in the file, print an empty list if the server responds
+    # with "304 Not Modified" and otherwise store the new validators in the file.
+    # Plugins can also support running as a long-lived worker that handles both list and download requests, see PluginWorker.
+    # Python plugins can instead be loaded into automedia and called directly, see get_python_plugin.
+    http_cache_filepath = os.path.join(html_tracked_dir, tracked_html.title, "http_cache")
+    items = plugin_list(plugin_entry, tracked_html.link, tracked_html, http_cache_filepath)
     if not items:
         return None
+    metrics.inc("automedia_new_items_total", len(items), type="html")
+
+    # Don't keep the validators until all items have been downloaded, otherwise items that failed to download
+    # (or weren't downloaded because we crashed) would not be retried until the list changes again
+    http_cache = get_http_cache(os.path.join(html_tracked_dir, tracked_html.title))
+    set_http_cache(os.path.join(html_tracked_dir, tracked_html.title), None, None)
 
     # Start downloading asynchronously using url.
     # A file called ".in_progress" should be added to the download directory when the download is in progress.
     # The ".in_progress" file should contain the url that was used to download the item.
+    # If the download directory already contains files from a download that was interrupted, then the program
+    # should only download the files that are missing, for example by keeping a manifest of the downloaded files.
     # A file called ".finished" should be added to the download directory when the download has finished.
     # ./program download url download_dir
     latest = None
@@ -562,16 +1730,73 @@ def sync_html(tracked_html, download_dir, session_id):
         with open(os.path.join(item_dir, ".session_id"), "w") as file:
             file.write(session_id)
 
-        html_update_latest(html_tracked_dir, tracked_html, name, url)
+        with metrics.timer("automedia_state_write_seconds", type="html"):
+            html_update_latest(html_tracked_dir, tracked_html, name, url)
 
+        item_name = os.path.join(tracked_html.title, name)
+        html_download_watcher.add(item_name, item_dir)
         if not plugin_download(plugin_entry, url, item_dir):
+            html_download_watcher.remove(item_name)
             return latest
 
         latest = name
         if not only_show_finished_notification:
             show_notification("Download started", "{}/{}".format(tracked_html.title, name))
+
+    set_http_cache(os.path.join(html_tracked_dir, tracked_html.title), http_cache.get("etag"), http_cache.get("modified"))
     return latest
 
+# Sync @tracked (of @media_type "rss" or "html") and put (media type, tracked, failed) in @finished_items when done,
+# even if syncing failed. Items of the same html are still downloaded one at a time from the oldest to the newest
+def sync_tracked_item(media_type, tracked, download_dir, session_id, finished_items):
+    start_time = time.monotonic()
+    failed = False
+    try:
+        if media_type == "rss":
+            print("{}: rss: Syncing {}".format(str(datetime.today().isoformat()), tracked.title))
+            sync_rss(tracked)
+            tracked_update_synced(os.path.join(rss_config_dir, "tracked"), "rss", tracked)
+        else:
+            print("{}: html({}): Syncing {}".format(str(datetime.today().isoformat()), tracked.plugin, tracked.title))
+            sync_html(tracked, download_dir, session_id)
+            tracked_update_synced(os.path.join(html_config_dir, "tracked"), "html", tracked)
+    except Exception as e:
+        failed = True
+        metrics.inc("automedia_sync_failures_total", type=media_type)
+        print("{}: {}: Failed to sync {}, error: {}".format(str(datetime.today().isoformat()), media_type, tracked.title, str(e)))
+    finally:
+        metrics.observe("automedia_sync_seconds", time.monotonic() - start_time, type=media_type)
+        finished_items.put((media_type, tracked, failed))
+
+# Returns the time to retry syncing an item that has failed to sync @num_failures times in a row.
+# The first retry is after sync_rate_sec and the delay is doubled after every failure, up to max_sync_interval_sec
+def get_sync_retry_time(num_failures, sync_rate_sec, now):
+    return now + max(sync_rate_sec, min(sync_rate_sec * 2.0 ** min(num_failures - 1, 32), max_sync_interval_sec))
+
+# Time ordered queue of the events of the sync loop. Events that are due at the same time are returned in the order they were added
+class SyncScheduler:
+    def __init__(self):
+        self.events = []
+        self.counter = 0
+
+    def schedule(self, due_time, event, data=None):
+        heapq.heappush(self.events, (due_time, self.counter, event, data))
+        self.counter += 1
+
+    # Returns the number of seconds until the next event is due, or None if there are no events
+    def time_until_next(self, now):
+        if not self.events:
+            return None
+        return max(0.0, self.events[0][0] - now)
+
+    # Removes and returns (event, data) of the events that are due at @now
+    def pop_due(self, now):
+        due_events = []
+        while self.events and self.events[0][0] <= now:
+            _, _, event, data = heapq.heappop(self.events)
+            due_events.append((event, data))
+        return due_events
+
 def sync(rss_config_dir, html_config_dir, download_dir, sync_rate_sec):
     os.makedirs(download_dir, exist_ok=True)
     if not is_torrent_daemon_running():
@@ -582,62 +1807,166 @@ def sync(rss_config_dir, html_config_dir, download_dir, sync_rate_sec):
 
     rss_tracked_dir = os.path.join(rss_config_dir, "tracked")
     html_tracked_dir = os.path.join(html_config_dir, "tracked")
-    # This is also check rate for html items
     check_torrent_status_rate_sec = 15
-    unfinished_torrents = []
-    unfinished_html_items = []
+    check_html_status_rate_sec = 15
+    # How often the tracked directories are checked for items that have been added or removed
+    refresh_tracked_rate_sec = 15
+    known_torrents = {}
+    # All torrents are requested once per sync_rate_sec to find removed torrents,
+    # in between only the torrents that have changed are requested
+    all_torrents_checked = 0
 
     # TODO: Remove this and keep a list of "in progress" html items in memory instead.
     session_id = uuid.uuid4().hex
 
-    tc = transmissionrpc.Client("127.0.0.1")
-    
-    running = True
-    tracked_rss = []
-    while running:
-        tracked_rss = get_tracked_rss(rss_tracked_dir, tracked_rss)
-        for rss in tracked_rss:
-            print("{}: rss: Syncing {}".format(str(datetime.today().isoformat()), rss.title))
-            sync_rss(rss)
-            # Add last synced timestamp. This together with "updated" file is used to remove series
-            # that haven't updated in a long time (either finished series or axes series)
-            with open(os.path.join(rss_tracked_dir, rss.title, "synced"), "w") as file:
-                file.write(str(time.time()))
-            #else:
-            #    print("No 'latest' item found for rss (maybe we already have the latest item?) %s" % rss.title)
-            #time.sleep(0.5) # Sleep between fetching rss so we don't get banned for spamming
-
-        tracked_html = get_tracked_html(html_tracked_dir)
-        for html in tracked_html:
-            print("{}: html({}): Syncing {}".format(str(datetime.today().isoformat()), html.plugin, html.title))
-            sync_html(html, download_dir, session_id)
-            # Add last synced timestamp. This together with "updated" file is used to remove series
-            # that haven't updated in a long time (either finished series or axes series)
-            with open(os.path.join(html_tracked_dir, html.title, "synced"), "w") as file:
-                file.write(str(time.time()))
-            #else:
-            #    print("No 'latest' item found for html (maybe we already have the latest item?) %s" % html.title)
-            #time.sleep(0.5) # Sleep between fetching html so we don't get banned for spamming
-        
-        # Check torrent status with sleeping until it's time to sync rss
-        count = 0
-        while count < sync_rate_sec/check_torrent_status_rate_sec:
-            html_items = get_html_items_progress(download_dir, tracked_html)
-            finished_html_items = [html_item for html_item in html_items if html_item.finished]
-            newly_finished_html_items = get_matching_html_items_by_name(finished_html_items, unfinished_html_items)
-            for newly_finished_html_item in newly_finished_html_items:
-                show_notification("Download finished", newly_finished_html_item)
-            unfinished_html_items = [html_item for html_item in html_items if not html_item.finished]
-
-            torrents = get_torrent_progress(tc)
-            finished_torrents = get_finished_torrents(torrents)
-            newly_finished_torrents = get_matching_torrents_by_name(finished_torrents, unfinished_torrents)
-            for newly_finished_torrent in newly_finished_torrents:
-                show_notification("Download finished", newly_finished_torrent)
-            unfinished_torrents = get_unfinished_torrents(torrents)
-
-            time.sleep(check_torrent_status_rate_sec)
-            count += 1
+    registries = {
+        "rss": TrackedRegistry(rss_tracked_dir, load_tracked_rss),
+        "html": TrackedRegistry(html_tracked_dir, load_tracked_html)
+    }
+    # Rss and html items are synced in separate thread pools so slow plugins don't delay rss
+    executors = {
+        "rss": ThreadPoolExecutor(max_workers=rss_fetch_workers),
+        "html": ThreadPoolExecutor(max_workers=html_sync_workers)
+    }
+    # (media type, title) -> tracked item. Sync events of items that have been removed or replaced since they were scheduled are ignored
+    scheduled_items = {}
+    # (media type, title) -> time the item is scheduled to be synced. Sync events for other times are ignored,
+    # which allows an item to be synced earlier than it was scheduled
+    next_sync_times = {}
+    # (media type, title) of items that are being synced. They are scheduled again when they are finished
+    running_items = set()
+    # (media type, title) -> number of times in a row the item has failed to sync (see get_sync_retry_time)
+    sync_failures = {}
+    finished_items = queue.Queue()
+
+    # Every item is synced when it's due (see get_next_sync_time), independent of other items,
+    # and download progress is checked on its own timer
+    scheduler = SyncScheduler()
+
+    def schedule_sync(media_type, tracked, due_time):
+        next_sync_times[(media_type, tracked.title)] = due_time
+        scheduler.schedule(due_time, "sync_item", (media_type, tracked, due_time))
+
+    # Items that were being added when automedia last stopped are removed before they are loaded
+    now = time.time()
+    remove_stale_tracked_items(rss_tracked_dir, "rss", now)
+    remove_stale_tracked_items(html_tracked_dir, "html", now)
+
+    scheduler.schedule(now, "refresh_tracked")
+    scheduler.schedule(now, "recover_in_progress")
+    scheduler.schedule(now, "check_torrents")
+    if remove_seeded_torrents:
+        scheduler.schedule(now, "remove_seeded_torrents")
+    scheduler.schedule(now, "check_html")
+    scheduler.schedule(now + metrics_write_rate_sec, "write_metrics")
+    if metrics_http_port:
+        try:
+            metrics.start_http_server(metrics_http_port)
+        except OSError as e:
+            print("Failed to serve metrics on port {}, error: {}".format(metrics_http_port, str(e)))
+
+    try:
+        running = True
+        while running:
+            now = time.time()
+            for event, data in scheduler.pop_due(now):
+                if event == "refresh_tracked":
+                    for media_type, registry in registries.items():
+                        titles = set()
+                        for tracked in registry.refresh():
+                            key = (media_type, tracked.title)
+                            titles.add(key)
+                            if scheduled_items.get(key) is tracked:
+                                continue
+                            scheduled_items[key] = tracked
+                            if key not in running_items:
+                                schedule_sync(media_type, tracked, get_next_sync_time(tracked, sync_rate_sec, now))
+                        for key in list(scheduled_items.keys()):
+                            if key[0] == media_type and key not in titles:
+                                del scheduled_items[key]
+                                next_sync_times.pop(key, None)
+                                sync_failures.pop(key, None)
+                        metrics.set("automedia_tracked_items", len(titles), type=media_type)
+                    scheduler.schedule(now + refresh_tracked_rate_sec, "refresh_tracked")
+                elif event == "sync_item":
+                    media_type, tracked, due_time = data
+                    key = (media_type, tracked.title)
+                    if scheduled_items.get(key) is not tracked or next_sync_times.get(key) != due_time or key in running_items:
+                        continue
+                    running_items.add(key)
+                    executors[media_type].submit(sync_tracked_item, media_type, tracked, download_dir, session_id, finished_items)
+                elif event == "check_torrents":
+                    all_torrents = now - all_torrents_checked >= sync_rate_sec
+                    torrents = get_torrent_progress(recently_active=not all_torrents)
+                    if torrents is not None:
+                        if all_torrents:
+                            all_torrents_checked = now
+                        newly_finished_torrents = update_torrent_progress(known_torrents, torrents, all_torrents)
+                        for newly_finished_torrent in newly_finished_torrents:
+                            show_notification("Download finished", newly_finished_torrent)
+                        metrics.set("automedia_torrents", len(known_torrents))
+                    scheduler.schedule(now + check_torrent_status_rate_sec, "check_torrents")
+                elif event == "remove_seeded_torrents":
+                    removed_torrent_ids = remove_torrents_done_seeding(now)
+                    if removed_torrent_ids:
+                        for torrent_id in removed_torrent_ids:
+                            known_torrents.pop(torrent_id, None)
+                        metrics.set("automedia_torrents", len(known_torrents))
+                    scheduler.schedule(now + torrent_removal_check_rate_sec, "remove_seeded_torrents")
+                elif event == "check_html":
+                    for newly_finished_html_item in html_download_watcher.get_newly_finished():
+                        show_notification("Download finished", newly_finished_html_item)
+                    scheduler.schedule(now + check_html_status_rate_sec, "check_html")
+                elif event == "recover_in_progress":
+                    remove_stale_tracked_items(rss_tracked_dir, "rss", now)
+                    remove_stale_tracked_items(html_tracked_dir, "html", now)
+                    # Html items with stopped downloads are synced now, which resumes the downloads
+                    for key, tracked in scheduled_items.items():
+                        if key[0] != "html" or tracked.resume_pending or not get_stalled_downloads(download_dir, tracked, session_id, now):
+                            continue
+                        tracked.resume_pending = True
+                        if key not in running_items:
+                            schedule_sync("html", tracked, now)
+                    scheduler.schedule(now + in_progress_sweep_rate_sec, "recover_in_progress")
+                elif event == "write_metrics":
+                    metrics.set("automedia_running_syncs", len(running_items))
+                    try:
+                        metrics.write_file(metrics_file_path)
+                    except OSError as e:
+                        print("Failed to write metrics to {}, error: {}".format(metrics_file_path, str(e)))
+                    scheduler.schedule(now + metrics_write_rate_sec, "write_metrics")
+
+            # Wait until the next event is due or an item has finished syncing
+            try:
+                finished = [finished_items.get(timeout=scheduler.time_until_next(time.time()))]
+            except queue.Empty:
+                continue
+            while not finished_items.empty():
+                finished.append(finished_items.get())
+
+            now = time.time()
+            for media_type, tracked, failed in finished:
+                key = (media_type, tracked.title)
+                running_items.discard(key)
+                if failed:
+                    sync_failures[key] = sync_failures.get(key, 0) + 1
+                else:
+                    sync_failures.pop(key, None)
+                tracked = scheduled_items.get(key)
+                if tracked:
+                    # Items that failed to sync are not synced again right away, since the same error would most likely happen again
+                    if failed:
+                        schedule_sync(media_type, tracked, get_sync_retry_time(sync_failures[key], sync_rate_sec, now))
+                    # Stopped downloads that were found while the item was syncing are resumed right away
+                    elif media_type == "html" and tracked.resume_pending:
+                        schedule_sync(media_type, tracked, now)
+                    else:
+                        schedule_sync(media_type, tracked, get_next_sync_time(tracked, sync_rate_sec, now))
+    finally:
+        # Syncs that haven't started are cancelled when sync stops (for example on SIGINT). Syncs that are running
+        # are finished before the process exits, see command_sync
+        for executor in executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
 
 def usage():
     print("usage: automedia.py COMMAND")
@@ -645,18 +1974,23 @@ def usage():
     print("COMMANDS")
     print("  add\tAdd media to track")
     print("  sync\tStart syncing tracked media")
+    print("  downloaded\tList downloaded media, sorted from the oldest to the newest")
+    print("  migrate\tMove the state of tracked media into a sqlite database (%s). Sync should not be running when migrating" % state_db_path)
     exit(1)
 
 def usage_add():
     print("usage: automedia.py add <type> <url> [--name name] [--start-after start_after]")
+    print("       automedia.py add --from-file <file>")
     print("OPTIONS")
     print("  type\t\tThe type should be either rss or html")
     print("  url\t\tThe url to the rss or html")
     print("  --name\t\tThe display name to be used for the media. Optional for rss, in which case the name will be retries from rss TITLE, required for html")
     print("  --start-after\t\tThe sync should start downloading media after this item (Optional, default is to start from the first item)")
+    print("  --from-file\t\tAdd all media in a json, csv or opml file. Json files should have a list of objects with type, url, name and start_after keys and csv files should have a header row with those columns. Opml outlines should have either xmlUrl (rss) or htmlUrl (html) and optionally title and startAfter")
     print("EXAMPLES")
     print("  automedia.py add rss 'https://nyaa.si/?page=rss&q=Tejina-senpai+1080p&c=0_0&f=0&u=HorribleSubs'")
     print("  automedia.py add html 'https://manganelo.com/manga/read_naruto_manga_online_free3' --name Naruto")
+    print("  automedia.py add --from-file subscriptions.opml")
     exit(1)
 
 def usage_sync():
@@ -667,10 +2001,26 @@ def usage_sync():
     print("  automedia.py sync /home/adam/Downloads/automedia")
     exit(1)
 
+def usage_downloaded():
+    print("usage: automedia.py downloaded [--limit limit] [--since since]")
+    print("OPTIONS")
+    print("  --limit\t\tOnly list the newest limit items (Optional)")
+    print("  --since\t\tOnly list items downloaded after this unix timestamp (Optional)")
+    print("EXAMPLES")
+    print("  automedia.py downloaded --limit 50")
+    exit(1)
+
 def command_add(args):
     if len(args) < 2:
         usage_add()
 
+    if args[0] == "--from-file":
+        if len(args) != 2:
+            usage_add()
+        if not add_from_file(args[1]):
+            exit(2)
+        return
+
     media_type = args[0]
     media_url = args[1]
     media_name = None
@@ -742,52 +2092,232 @@ def command_sync(args):
             os.remove(automedia_pid_path)
 
     def signal_handler(signum, frame):
-        os.unlink(automedia_pid_path)
         exit(1)
     signal.signal(signal.SIGINT, signal_handler)
 
     os.write(pid_file, ("%s" % os.getpid()).encode())
     os.close(pid_file)
+    # The pid file is removed when the process exits, which is after the syncs that were running when sync stopped have finished.
+    # Another sync can't be started until then
+    atexit.register(os.unlink, automedia_pid_path)
 
     os.makedirs(rss_config_dir, exist_ok=True)
     os.makedirs(html_config_dir, exist_ok=True)
+    if not open_state_db() and not os.path.isfile(downloaded_index_path):
+        downloaded_index_build()
 
     sync_rate_sec = 15 * 60 # every 15 min
     sync(rss_config_dir, html_config_dir, download_dir, sync_rate_sec)
 
+# Imports all tracked items that are not already in the sqlite database. Tracked items that are added later
+# are imported by sync the first time they are loaded
+def command_migrate():
+    global state_db
+    os.makedirs(config_dir, exist_ok=True)
+    state_db = StateDb(state_db_path)
+
+    num_migrated = 0
+    for media_type, tracked_dir, load_func in [("rss", os.path.join(rss_config_dir, "tracked"), load_tracked_rss), ("html", os.path.join(html_config_dir, "tracked"), load_tracked_html)]:
+        try:
+            for title in os.listdir(tracked_dir):
+                if not state_db.has_tracked(media_type, title) and load_func(tracked_dir, title):
+                    num_migrated += 1
+        except FileNotFoundError:
+            pass
+    state_db.close()
+    state_db = None
+    print("Migrated {} tracked items to {}".format(num_migrated, state_db_path))
+
 def data_file_get_downloaded(data_filepath):
     downloaded = []
     try:
-        with open(data_filepath, "r") as file:
-            for item in json.loads(file.read())["downloaded"]:
+        json_data = data_file_load(data_filepath)
+        if json_data:
+            for item in json_data["downloaded"]:
                 downloaded.append(item)
     except OSError:
         pass
     return downloaded
 
-def get_downloaded_items(tracked_dir, is_html):
+def get_downloaded_items(tracked_dir, media_type):
     downloaded_items = []
     try:
-        downloaded_items = []
         for name in os.listdir(tracked_dir):
             data_filepath = os.path.join(tracked_dir, name, "data")
             downloaded = data_file_get_downloaded(data_filepath)
             for item in downloaded:
                 if item.get("time"):
-                    if is_html:
-                        item["title"] = os.path.join(name, item["title"])
-                    downloaded_items.append(item)
+                    downloaded_items.append({ "type": media_type, "tracked_title": name, "title": item["title"], "time": item["time"] })
     except OSError:
         pass
     return downloaded_items
 
-def command_downloaded():
+def downloaded_index_build():
     downloaded_items = []
-    downloaded_items.extend(get_downloaded_items(os.path.join(rss_config_dir, "tracked"), False))
-    downloaded_items.extend(get_downloaded_items(os.path.join(html_config_dir, "tracked"), True))
+    downloaded_items.extend(get_downloaded_items(os.path.join(rss_config_dir, "tracked"), "rss"))
+    downloaded_items.extend(get_downloaded_items(os.path.join(html_config_dir, "tracked"), "html"))
     downloaded_items = sorted(downloaded_items, key=lambda item: float(item["time"]))
-    for item in downloaded_items:
-        print(item["title"])
+
+    os.makedirs(config_dir, exist_ok=True)
+    tmp_index_path = downloaded_index_path + ".tmp"
+    with open(tmp_index_path, "w") as file:
+        for item in downloaded_items:
+            file.write(json.dumps(item) + "\n")
+    os.replace(tmp_index_path, downloaded_index_path)
+
+# Returns the offset of the first line in the index that is newer than @since.
+# This is a binary search over the byte offsets of the file, since the lines are sorted by time
+def downloaded_index_find_since(file, file_size, since):
+    # Returns the offset and content of the first line that starts at or after @offset
+    def get_line_at(offset):
+        if offset > 0:
+            file.seek(offset - 1)
+            file.readline()
+        else:
+            file.seek(0)
+        return file.tell(), file.readline()
+
+    # Returns the time of the first line that starts at or after @offset, or None if there is no such line.
+    # Lines that were only partially written (for example if the computer crashed while appending to the index) are skipped
+    def get_time_at(offset):
+        _, line = get_line_at(offset)
+        while line:
+            try:
+                return float(json.loads(line)["time"])
+            except (json.decoder.JSONDecodeError, KeyError, TypeError, ValueError):
+                line = file.readline()
+        return None
+
+    low = 0
+    high = file_size
+    while low < high:
+        middle = (low + high) // 2
+        line_time = get_time_at(middle)
+        if line_time is None or line_time > since:
+            high = middle
+        else:
+            low = middle + 1
+    return get_line_at(low)[0]
+
+# Yields the lines of the index from the last to the first
+def downloaded_index_read_backward(file, file_size):
+    block_size = 64 * 1024
+    offset = file_size
+    # The start of the line at the end of the previous block, which continues in the next block
+    remainder = b""
+    while offset > 0:
+        read_size = min(block_size, offset)
+        offset -= read_size
+        file.seek(offset)
+        lines = (file.read(read_size) + remainder).split(b"\n")
+        remainder = lines[0]
+        for line in reversed(lines[1:]):
+            if line:
+                yield line
+    if remainder:
+        yield remainder
+
+# Returns the item of a line in the index, or None if the line was only partially written
+# (for example if the computer crashed while appending to the index)
+def parse_downloaded_index_line(line):
+    try:
+        item = json.loads(line)
+        float(item["time"])
+        if item["type"] in ("rss", "html") and isinstance(item["tracked_title"], str) and isinstance(item["title"], str):
+            return item
+    except (json.decoder.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, ValueError):
+        pass
+    return None
+
+def get_tracked_titles():
+    tracked_titles = { "rss": set(), "html": set() }
+    for media_type, tracked_dir in [("rss", os.path.join(rss_config_dir, "tracked")), ("html", os.path.join(html_config_dir, "tracked"))]:
+        try:
+            tracked_titles[media_type].update(os.listdir(tracked_dir))
+        except FileNotFoundError:
+            pass
+    return tracked_titles
+
+# Yields the titles of the downloaded items of media that is still tracked, from the oldest to the newest.
+# Only the newest @limit items and items that are newer than @since (unix timestamp) are returned, if they are set
+def get_downloaded_titles(limit=None, since=None):
+    tracked_titles = get_tracked_titles()
+
+    def get_display_title(media_type, tracked_title, title):
+        if media_type == "html":
+            return os.path.join(tracked_title, title)
+        return title
+
+    if state_db:
+        for media_type, tracked_title, title, _ in state_db.get_downloaded(tracked_titles, limit, since):
+            yield get_display_title(media_type, tracked_title, title)
+        return
+
+    if not os.path.isfile(downloaded_index_path):
+        downloaded_index_build()
+
+    with open(downloaded_index_path, "rb") as file:
+        file_size = os.fstat(file.fileno()).st_size
+        if limit is None:
+            offset = 0
+            if since is not None:
+                offset = downloaded_index_find_since(file, file_size, since)
+            file.seek(offset)
+            for line in file:
+                item = parse_downloaded_index_line(line)
+                if item and item["tracked_title"] in tracked_titles[item["type"]]:
+                    yield get_display_title(item["type"], item["tracked_title"], item["title"])
+            return
+
+        # The index also has items of media that is no longer tracked and lines that were only partially written,
+        # so lines are read from the end until @limit items of tracked media have been found
+        items = []
+        for line in downloaded_index_read_backward(file, file_size):
+            if len(items) >= limit:
+                break
+            item = parse_downloaded_index_line(line)
+            if not item:
+                continue
+            if since is not None and float(item["time"]) <= since:
+                break
+            if item["tracked_title"] in tracked_titles[item["type"]]:
+                items.append(item)
+
+    for item in reversed(items):
+        yield get_display_title(item["type"], item["tracked_title"], item["title"])
+
+def command_downloaded(args):
+    limit = None
+    since = None
+
+    option = None
+    for arg in args:
+        if arg in [ "--limit", "--since" ]:
+            if option:
+                usage_downloaded()
+            option = arg
+        else:
+            if not option:
+                usage_downloaded()
+
+            try:
+                if option == "--limit":
+                    limit = int(arg)
+                elif option == "--since":
+                    since = float(arg)
+            except ValueError:
+                usage_downloaded()
+            option = None
+
+    if option:
+        usage_downloaded()
+
+    open_state_db()
+    if limit is not None and limit <= 0:
+        return
+
+    for title in get_downloaded_titles(limit, since):
+        print(title)
 
 def main():
     if len(sys.argv) < 2:
@@ -799,7 +2329,9 @@ def main():
     elif command == "sync":
         command_sync(sys.argv[2:])
     elif command == "downloaded":
-        command_downloaded()
+        command_downloaded(sys.argv[2:])
+    elif command == "migrate":
+        command_migrate()
     else:
         usage()
 
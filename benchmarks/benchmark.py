@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import threading
+import uuid
+import contextlib
+
+from concurrent.futures import ThreadPoolExecutor
+from servers import MediaServer, FakeTransmission
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# Set by main after the config directory has been redirected to the benchmark directory
+automedia = None
+
+def usage():
+    print("usage: benchmark.py [--feeds feeds] [--html html] [--history history] [--new-items new_items] [--images images] [--state-db] [--sync] [--no-rate-limit] [--keep]")
+    print("OPTIONS")
+    print("  --feeds\t\tNumber of tracked rss feeds (Optional, default 100)")
+    print("  --html\t\tNumber of tracked html items (Optional, default 10)")
+    print("  --history\t\tNumber of downloaded items of every tracked item (Optional, default 200)")
+    print("  --new-items\t\tNumber of new items that are released for every tracked item before each sync (Optional, default 2)")
+    print("  --images\t\tNumber of images in every chapter (Optional, default 5)")
+    print("  --state-db\t\tMigrate the tracked items to the sqlite database before syncing (Optional)")
+    print("  --sync\t\tAlso measure the first pass of the sync command (Optional)")
+    print("  --no-rate-limit\tDon't limit the rate of requests per host. All requests go to the same local server, so with the limit the results mostly show the configured rate (Optional)")
+    print("  --keep\t\tDon't remove the benchmark directory when done (Optional)")
+    print("EXAMPLES")
+    print("  benchmark.py --feeds 1000 --history 1000 --state-db")
+    exit(1)
+
+# Create the tracked items in the automedia config directory. Every item has already downloaded the first @history items of the server
+def generate_config(server, num_feeds, num_html, history):
+    now = time.time()
+    item_times = [now - (history - i) * 60 * 60 for i in range(history)]
+
+    rss_tracked_dir = os.path.join(automedia.rss_config_dir, "tracked")
+    for feed in range(num_feeds):
+        title = "Feed %d" % feed
+        downloaded = []
+        for episode in range(1, history + 1):
+            downloaded.append({ "title": server.get_rss_item_title(feed, episode), "time": str(item_times[episode - 1]), "url": server.get_rss_item_link(feed, episode) })
+        write_tracked_item(os.path.join(rss_tracked_dir, title), { "link": server.get_rss_url(feed), "updated": str(now), "downloaded": downloaded })
+
+    html_tracked_dir = os.path.join(automedia.html_config_dir, "tracked")
+    for manga in range(num_html):
+        title = "Manga %d" % manga
+        downloaded = []
+        for chapter in range(1, history + 1):
+            downloaded.append({ "title": server.get_chapter_title(chapter), "time": str(item_times[chapter - 1]), "url": server.get_chapter_url(manga, chapter) })
+        write_tracked_item(os.path.join(html_tracked_dir, title), { "plugin": "manganelo.py", "link": server.get_manga_url(manga), "updated": str(now), "downloaded": downloaded })
+    return num_feeds + num_html
+
+def write_tracked_item(item_dir, data):
+    os.makedirs(item_dir)
+    with open(os.path.join(item_dir, "link"), "w") as file:
+        file.write(data["link"])
+    if "plugin" in data:
+        with open(os.path.join(item_dir, "plugin"), "w") as file:
+            file.write(data["plugin"])
+    if data["downloaded"]:
+        with open(os.path.join(item_dir, "latest"), "w") as file:
+            file.write(data["downloaded"][-1]["title"])
+    with open(os.path.join(item_dir, "data"), "w") as file:
+        json.dump(data, file, indent=4)
+
+# Run @func with a thread pool of @num_workers threads for every item in @items, the same way the sync command does
+def run_in_pool(func, items, num_workers):
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for future in [executor.submit(func, item) for item in items]:
+            future.result()
+
+def count_finished_chapters(download_dir):
+    num_finished = 0
+    for root, dirs, files in os.walk(download_dir):
+        if ".finished" in files:
+            num_finished += 1
+    return num_finished
+
+def wait_until(condition, timeout_sec):
+    end_time = time.time() + timeout_sec
+    while time.time() < end_time:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+class Benchmark:
+    def __init__(self):
+        # (stage, seconds, number of items)
+        self.results = []
+
+    # @func should return the number of items that were processed in the stage
+    def run_stage(self, name, func):
+        start_time = time.perf_counter()
+        num_items = func()
+        elapsed_time = time.perf_counter() - start_time
+        self.results.append((name, elapsed_time, num_items))
+        print("{}: {:.3f} sec".format(name, elapsed_time), file=sys.stderr)
+
+    def print_results(self):
+        print("{:<36} {:>10} {:>10} {:>12}".format("stage", "time (s)", "items", "items/s"))
+        for name, elapsed_time, num_items in self.results:
+            throughput = num_items / elapsed_time if elapsed_time > 0 else 0.0
+            print("{:<36} {:>10.3f} {:>10} {:>12.1f}".format(name, elapsed_time, num_items, throughput))
+
+def run_benchmark(benchmark, server, transmission, work_dir, num_feeds, num_html, history, new_items, use_state_db, measure_sync):
+    rss_tracked_dir = os.path.join(automedia.rss_config_dir, "tracked")
+    html_tracked_dir = os.path.join(automedia.html_config_dir, "tracked")
+    download_dir = os.path.join(work_dir, "downloads")
+    os.makedirs(download_dir)
+
+    benchmark.run_stage("generate config", lambda: generate_config(server, num_feeds, num_html, history))
+    if use_state_db:
+        benchmark.run_stage("migrate", lambda: automedia.command_migrate() or num_feeds + num_html)
+        automedia.open_state_db()
+    else:
+        benchmark.run_stage("downloaded index build", lambda: automedia.downloaded_index_build() or (num_feeds + num_html) * history)
+
+    tracked_rss = []
+    tracked_html = []
+
+    def load_stage(tracked, get_tracked_func, tracked_dir):
+        tracked.extend(get_tracked_func(tracked_dir))
+        return len(tracked)
+
+    benchmark.run_stage("get_tracked_rss", lambda: load_stage(tracked_rss, automedia.get_tracked_rss, rss_tracked_dir))
+    benchmark.run_stage("get_tracked_html", lambda: load_stage(tracked_html, automedia.get_tracked_html, html_tracked_dir))
+
+    registry = automedia.TrackedRegistry(rss_tracked_dir, automedia.load_tracked_rss)
+    benchmark.run_stage("TrackedRegistry.refresh (first)", lambda: len(registry.refresh()))
+    benchmark.run_stage("TrackedRegistry.refresh (unchanged)", lambda: len(registry.refresh()))
+
+    def sync_rss_stage():
+        num_torrents = len(transmission.torrents)
+        run_in_pool(automedia.sync_rss, tracked_rss, automedia.rss_fetch_workers)
+        return len(transmission.torrents) - num_torrents
+
+    def sync_html_stage():
+        num_finished = count_finished_chapters(download_dir)
+        session_id = uuid.uuid4().hex
+        run_in_pool(lambda html: automedia.sync_html(html, download_dir, session_id), tracked_html, automedia.html_sync_workers)
+        return count_finished_chapters(download_dir) - num_finished
+
+    benchmark.run_stage("sync_rss (new items)", sync_rss_stage)
+    benchmark.run_stage("sync_rss (unchanged)", lambda: sync_rss_stage() or len(tracked_rss))
+    benchmark.run_stage("sync_html (new chapters)", sync_html_stage)
+    benchmark.run_stage("sync_html (unchanged)", lambda: sync_html_stage() or len(tracked_html))
+
+    benchmark.run_stage("downloaded --limit 50", lambda: sum(1 for _ in automedia.get_downloaded_titles(50)))
+    benchmark.run_stage("downloaded", lambda: sum(1 for _ in automedia.get_downloaded_titles()))
+
+    if measure_sync:
+        # Release new items and measure how long it takes for the sync command to download all of them
+        server.new_items += new_items
+        expected_torrents = len(transmission.torrents) + num_feeds * new_items
+        expected_chapters = count_finished_chapters(download_dir) + num_html * new_items
+
+        def sync_stage():
+            threading.Thread(target=automedia.sync, args=(automedia.rss_config_dir, automedia.html_config_dir, download_dir, 60 * 60), daemon=True).start()
+            if not wait_until(lambda: len(transmission.torrents) >= expected_torrents and count_finished_chapters(download_dir) >= expected_chapters, 60 * 10):
+                print("Sync didn't finish within 10 minutes", file=sys.stderr)
+            return num_feeds + num_html
+        benchmark.run_stage("sync (first pass)", sync_stage)
+
+def main():
+    global automedia
+    options = {
+        "--feeds": 100,
+        "--html": 10,
+        "--history": 200,
+        "--new-items": 2,
+        "--images": 5
+    }
+    use_state_db = False
+    measure_sync = False
+    rate_limit = True
+    keep = False
+
+    option = None
+    for arg in sys.argv[1:]:
+        if option:
+            try:
+                options[option] = int(arg)
+            except ValueError:
+                usage()
+            option = None
+        elif arg in options:
+            option = arg
+        elif arg == "--state-db":
+            use_state_db = True
+        elif arg == "--sync":
+            measure_sync = True
+        elif arg == "--no-rate-limit":
+            rate_limit = False
+        elif arg == "--keep":
+            keep = True
+        else:
+            usage()
+
+    if option:
+        usage()
+
+    num_feeds = options["--feeds"]
+    num_html = options["--html"]
+    history = options["--history"]
+    new_items = options["--new-items"]
+
+    # automedia finds its config directory from the home directory when it's imported
+    work_dir = tempfile.mkdtemp(prefix="automedia-benchmark-")
+    os.environ["HOME"] = work_dir
+    sys.path.insert(0, repo_dir)
+    import automedia as automedia_module
+    automedia = automedia_module
+    automedia.script_dir = repo_dir
+    automedia.show_notification = lambda title, body, urgency="normal": None
+    if not rate_limit:
+        automedia.host_rate_limiter.rate = 1e9
+        automedia.host_rate_limiter.burst = 1e9
+
+    server = MediaServer(history, new_items, options["--images"])
+    transmission = FakeTransmission()
+    automedia.torrent_rpc_port = transmission.port
+
+    benchmark = Benchmark()
+    try:
+        # The output of automedia goes to stderr so stdout only has the results
+        with contextlib.redirect_stdout(sys.stderr):
+            run_benchmark(benchmark, server, transmission, work_dir, num_feeds, num_html, history, new_items, use_state_db, measure_sync)
+    finally:
+        server.close()
+        transmission.close()
+        if keep:
+            print("Benchmark directory: {}".format(work_dir), file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("feeds: {}, html: {}, history: {}, new items: {}, images: {}, state db: {}, rate limit: {}".format(num_feeds, num_html, history, new_items, options["--images"], use_state_db,
+        "{}/s per host (burst {})".format(automedia.requests_per_host_per_sec, automedia.request_burst_per_host) if rate_limit else "off"))
+    benchmark.print_results()
+    print("")
+    print("http requests: {}".format(json.dumps(server.requests, sort_keys=True)))
+    print("transmission requests: {}".format(json.dumps(transmission.requests, sort_keys=True)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+import http.server
+
+# Local http server that stands in for the sites automedia syncs from. It serves generated rss feeds (/rss/<feed>)
+# and manganelo shaped pages: chapter lists (/manga/<manga>), chapters (/chapter/<manga>/<chapter>) and images.
+# Every feed and manga has @history items that the benchmark marks as downloaded, plus @new_items newer ones.
+# Increasing new_items releases more items, and changes the etag of the feeds and chapter lists
+class MediaServer:
+    def __init__(self, history, new_items, images_per_chapter, image_size=16 * 1024, rss_page_size=75):
+        self.history = history
+        self.new_items = new_items
+        self.images_per_chapter = images_per_chapter
+        self.image = b"\xff" * image_size
+        self.rss_page_size = rss_page_size
+        # path type ("rss", "manga", "chapter", "image") -> number of requests
+        self.requests = {}
+        self.lock = threading.Lock()
+
+        server = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_rss_url(self, feed):
+        return "%s/rss/%d" % (self.base_url, feed)
+
+    def get_manga_url(self, manga):
+        return "%s/manga/%d" % (self.base_url, manga)
+
+    def get_chapter_url(self, manga, chapter):
+        return "%s/chapter/%d/%d" % (self.base_url, manga, chapter)
+
+    @staticmethod
+    def get_rss_item_title(feed, episode):
+        return "Feed %d Episode %d" % (feed, episode)
+
+    @staticmethod
+    def get_rss_item_link(feed, episode):
+        return "magnet:?xt=urn:btih:%08x%08x" % (feed, episode)
+
+    @staticmethod
+    def get_chapter_title(chapter):
+        return "Chapter %d" % chapter
+
+    def handle(self, request):
+        parts = request.path.strip("/").split("/")
+        with self.lock:
+            self.requests[parts[0]] = self.requests.get(parts[0], 0) + 1
+
+        etag = '"%d"' % self.new_items
+        content_type = "text/html"
+        try:
+            if parts[0] == "rss" and len(parts) == 2:
+                if request.headers.get("If-None-Match") == etag:
+                    self.send(request, 304, b"", content_type, etag)
+                    return
+                body = self.build_rss(int(parts[1])).encode()
+                content_type = "application/rss+xml"
+            elif parts[0] == "manga" and len(parts) == 2:
+                if request.headers.get("If-None-Match") == etag:
+                    self.send(request, 304, b"", content_type, etag)
+                    return
+                body = self.build_chapter_list(int(parts[1])).encode()
+            elif parts[0] == "chapter" and len(parts) == 3:
+                body = self.build_chapter(int(parts[1]), int(parts[2])).encode()
+                etag = None
+            elif parts[0] == "image":
+                body = self.image
+                content_type = "image/jpeg"
+                etag = None
+            else:
+                self.send(request, 404, b"", content_type, None)
+                return
+        except ValueError:
+            self.send(request, 404, b"", content_type, None)
+            return
+        self.send(request, 200, body, content_type, etag)
+
+    def send(self, request, status, body, content_type, etag):
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        if etag:
+            request.send_header("ETag", etag)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def build_rss(self, feed):
+        latest = self.history + self.new_items
+        items = []
+        for episode in range(latest, max(0, latest - self.rss_page_size), -1):
+            items.append("<item><title>%s</title><link>%s</link><guid>%s</guid><pubDate>Mon, 01 Jan 2024 00:00:00 +0000</pubDate></item>" %
+                (self.get_rss_item_title(feed, episode), self.get_rss_item_link(feed, episode), self.get_rss_item_link(feed, episode)))
+        return '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Feed %d</title><link>%s</link><description>Feed %d</description>%s</channel></rss>' % (
+            feed, self.get_rss_url(feed), feed, "".join(items))
+
+    def build_chapter_list(self, manga):
+        chapters = []
+        for chapter in range(self.history + self.new_items, 0, -1):
+            chapters.append('<li><a href="%s">%s</a></li>' % (self.get_chapter_url(manga, chapter), self.get_chapter_title(chapter)))
+        return '<html><body><ul class="row-content-chapter">%s</ul></body></html>' % "".join(chapters)
+
+    def build_chapter(self, manga, chapter):
+        images = []
+        for image in range(self.images_per_chapter):
+            images.append('<img src="%s/image/%d/%d/%d.jpg"/>' % (self.base_url, manga, chapter, image))
+        return '<html><body><div class="container-chapter-reader">%s</div></body></html>' % "".join(images)
+
+# Stand-in for the rpc interface of the transmission daemon. Added torrents are kept in memory and are never downloaded
+class FakeTransmission:
+    session_id = "automedia-benchmark"
+
+    def __init__(self):
+        self.torrents = {}
+        self.next_id = 1
+        # rpc method -> number of requests
+        self.requests = {}
+        self.lock = threading.Lock()
+
+        server = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, request):
+        if request.headers.get("X-Transmission-Session-Id") != self.session_id:
+            request.send_response(409)
+            request.send_header("X-Transmission-Session-Id", self.session_id)
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+
+        rpc_request = json.loads(request.rfile.read(int(request.headers["Content-Length"])))
+        method = rpc_request["method"]
+        arguments = rpc_request.get("arguments", {})
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            result = self.handle_method(method, arguments)
+
+        body = json.dumps({ "result": "success", "arguments": result, "tag": rpc_request.get("tag") }).encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def handle_method(self, method, arguments):
+        if method == "session-get":
+            return { "rpc-version": 15, "version": "2.94" }
+        elif method == "torrent-add":
+            torrent_id = self.next_id
+            self.next_id += 1
+            torrent = {
+                "id": torrent_id,
+                "name": arguments["filename"],
+                "hashString": "%040x" % torrent_id,
+                "percentDone": 0.0,
+                "sizeWhenDone": 1024,
+                "leftUntilDone": 1024,
+                "uploadRatio": 0.0,
+                "addedDate": 0,
+                "doneDate": 0,
+                "status": 4
+            }
+            self.torrents[torrent_id] = torrent
+            return { "torrent-added": { "id": torrent_id, "name": torrent["name"], "hashString": torrent["hashString"] } }
+        elif method == "torrent-get":
+            torrent_ids = arguments.get("ids")
+            torrents = list(self.torrents.values())
+            if isinstance(torrent_ids, list):
+                torrents = [torrent for torrent in torrents if torrent["id"] in torrent_ids]
+            result = { "torrents": [{ field: torrent[field] for field in arguments["fields"] if field in torrent } for torrent in torrents] }
+            if torrent_ids == "recently-active":
+                result["removed"] = []
+            return result
+        elif method == "torrent-remove":
+            for torrent_id in arguments.get("ids", []):
+                self.torrents.pop(torrent_id, None)
+        return {}
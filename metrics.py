@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import threading
+import http.server
+from contextlib import contextmanager
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(name, escape_label_value(value)) for name, value in labels) + "}"
+
+# Counters, gauges and timers of the sync daemon, which can be written in the prometheus text format
+# to a file or served over http. Every metric can have labels, which are passed as keyword arguments
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> type ("counter", "gauge" or "summary")
+        self.types = {}
+        # name -> { labels -> value }, where the value of a summary is [count, sum]
+        self.values = {}
+        self.http_server = None
+
+    def _get_values(self, name, metric_type):
+        values = self.values.get(name)
+        if values is None:
+            values = {}
+            self.values[name] = values
+            self.types[name] = metric_type
+        return values
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self._get_values(name, "counter")
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self._get_values(name, "gauge")[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self._get_values(name, "summary")
+            summary = values.get(key)
+            if not summary:
+                summary = [0, 0.0]
+                values[key] = summary
+            summary[0] += 1
+            summary[1] += seconds
+
+    # Measures the wall time of the with block, also when it raises an exception
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start_time, **labels)
+
+    def to_prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.values.keys()):
+                metric_type = self.types[name]
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                for labels, value in sorted(self.values[name].items()):
+                    if metric_type == "summary":
+                        lines.append("{}_count{} {}".format(name, format_labels(labels), value[0]))
+                        lines.append("{}_sum{} {}".format(name, format_labels(labels), value[1]))
+                    else:
+                        lines.append("{}{} {}".format(name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    # The file is replaced atomically, so readers never see a partially written file
+    def write_file(self, filepath):
+        tmp_filepath = filepath + ".tmp"
+        with open(tmp_filepath, "w") as file:
+            file.write(self.to_prometheus_text())
+        os.replace(tmp_filepath, filepath)
+
+    # Serve the metrics on http://127.0.0.1:@port/metrics
+    def start_http_server(self, port):
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.to_prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
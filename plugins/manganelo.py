@@ -1,23 +1,36 @@
 #!/usr/bin/env python3
+# automedia: in-process
 
 import os
 import time
 import sys
 import requests
 import json
-import subprocess
+import hashlib
+import threading
 
 from lxml import etree
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of images that are downloaded at the same time when downloading a chapter
+download_threads = int(os.environ.get("AUTOMEDIA_DOWNLOAD_THREADS", "4"))
+# Print the images that are downloaded. Only enabled when running from the command line
+verbose = False
+# list_chapters accepts the list input from automedia with a fingerprint of the older chapters
+supports_list_fingerprint = True
 
 def usage():
     print("manganelo.py command")
     print("commands:")
     print("  download")
     print("  list")
+    print("  worker")
     exit(1)
 
 def usage_list():
     print("manganelo.py list <url>")
+    print("")
+    print("Note: If the AUTOMEDIA_HTTP_CACHE environment variable is set to the path of a file then the page is only downloaded if it has changed since the last time, in which case the validators in the file are updated.")
     exit(1)
 
 def usage_download():
@@ -26,24 +39,144 @@ def usage_download():
     print("  manganelo.py download \"https://manganelo.com/chapter/read_naruto_manga_online_free3/chapter_700.5\" /home/adam/Manga/MangaName")
     print("")
     print("Note: The manga directory has to exist.")
+    print("The number of images downloaded at the same time can be set with the AUTOMEDIA_DOWNLOAD_THREADS environment variable (default: 4).")
     exit(1)
 
-if len(sys.argv) < 2:
-    usage()
+class PluginError(Exception):
+    def __init__(self, message, exit_code=2):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+# The session keeps connections alive between requests, so each image doesn't need a new connection (and tls handshake)
+def create_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=download_threads, pool_maxsize=download_threads)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Returns the size and sha1 of the downloaded file, or None on failure
+def download_file(session, url, save_path):
+    try:
+        with session.get(url, stream=True) as response:
+            if response.status_code != 200:
+                print("Failed to download file: {}, error: server responded with status code {}".format(url, response.status_code))
+                return None
+            size = 0
+            sha1 = hashlib.sha1()
+            with open(save_path, "wb") as file:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    file.write(chunk)
+                    size += len(chunk)
+                    sha1.update(chunk)
+            return size, sha1.hexdigest()
+    except (requests.exceptions.RequestException, OSError) as e:
+        print("Failed to download file: {}, error: {}".format(url, str(e)))
+        return None
+
+def get_file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# The manifest (".manifest" in the chapter directory) has one json line for each image that has finished downloading,
+# with its url, size and sha1. It's used to only download the missing images when resuming a chapter download.
+class ChapterManifest:
+    def __init__(self, download_dir):
+        self.lock = threading.Lock()
+        self.filepath = os.path.join(download_dir, ".manifest")
+        self.download_dir = download_dir
+        self.images = {}
+        try:
+            with open(self.filepath, "r") as file:
+                for line in file:
+                    try:
+                        image = json.loads(line)
+                        self.images[image["name"]] = image
+                    except (json.decoder.JSONDecodeError, KeyError):
+                        pass
+        except FileNotFoundError:
+            pass
+
+    # Returns True if the image has been downloaded completely
+    def is_downloaded(self, image_name, url):
+        image = self.images.get(image_name)
+        if not image or image.get("url") != url:
+            return False
+        image_path = os.path.join(self.download_dir, image_name)
+        try:
+            return os.path.getsize(image_path) == image["size"] and get_file_sha1(image_path) == image["sha1"]
+        except OSError:
+            return False
 
-def download_file(url, save_path):
-    process = subprocess.Popen(["wget", "-q", "-o", "/dev/null", "-O", save_path, url], stderr=subprocess.PIPE)
-    _, stderr = process.communicate()
-    if process.returncode != 0:
-        print("Failed to download file: {}, error: {}".format(url, stderr.decode('utf-8')))
+    def add(self, image_name, url, size, sha1):
+        with self.lock:
+            with open(self.filepath, "a") as file:
+                file.write(json.dumps({ "name": image_name, "url": url, "size": size, "sha1": sha1 }) + "\n")
+
+    def remove(self):
+        try:
+            os.remove(self.filepath)
+        except FileNotFoundError:
+            pass
+
+def download_image(session, manifest, url, image_name):
+    result = download_file(session, url, os.path.join(manifest.download_dir, image_name))
+    if not result:
         return False
+    size, sha1 = result
+    manifest.add(image_name, url, size, sha1)
     return True
 
-def list_chapters(url, chapter_list_input):
-    response = requests.get(url)
+def get_http_cache(http_cache_filepath):
+    try:
+        with open(http_cache_filepath, "r") as file:
+            return json.loads(file.read())
+    except (OSError, json.decoder.JSONDecodeError):
+        return {}
+
+def set_http_cache(http_cache_filepath, etag, modified):
+    if not etag and not modified:
+        return
+    with open(http_cache_filepath, "w") as file:
+        json.dump({ "etag": etag, "modified": modified }, file)
+
+def get_hash(key, hash_length):
+    return hashlib.sha1(key.encode()).hexdigest()[:hash_length]
+
+# This plugin can also be imported by automedia and used in-process by calling list_chapters and download_chapter directly,
+# with @session being a requests session shared by automedia. PluginError is raised on failure.
+# @chapter_list_input is either a list of the downloaded chapters, or a dict with the latest downloaded chapters in "downloaded"
+# and the hashes of the titles and urls of the older chapters in "fingerprint"
+def list_chapters(url, chapter_list_input, http_cache_filepath, session=None):
+    url = url.replace("mangakakalot", "manganelo")
+    if not session:
+        session = requests.Session()
+
+    headers = {}
+    if http_cache_filepath:
+        http_cache = get_http_cache(http_cache_filepath)
+        if http_cache.get("etag"):
+            headers["If-None-Match"] = http_cache["etag"]
+        if http_cache.get("modified"):
+            headers["If-Modified-Since"] = http_cache["modified"]
+
+    response = session.get(url, headers=headers)
+    # The page hasn't changed since the last time, so there can't be any new chapters
+    if response.status_code == 304:
+        return []
     if response.status_code != 200:
-        print("Failed to list chapters, server responded with status code %d" % response.status_code)
-        exit(2)
+        raise PluginError("Failed to list chapters, server responded with status code %d" % response.status_code)
+
+    fingerprint = {}
+    if isinstance(chapter_list_input, dict):
+        fingerprint = chapter_list_input.get("fingerprint", {})
+        chapter_list_input = chapter_list_input.get("downloaded", [])
+    hash_length = fingerprint.get("hash_length", 12)
+    seen_title_hashes = set(fingerprint.get("titles", []))
+    seen_url_hashes = set(fingerprint.get("urls", []))
 
     seen_titles = set()
     for item in chapter_list_input:
@@ -62,54 +195,133 @@ def list_chapters(url, chapter_list_input):
     for element in tree.xpath('//ul[@class="row-content-chapter"]//a'):
         element_text = element.text.strip()
         url = element.attrib.get("href").strip()
-        if element_text.lower().replace(" ", "") in seen_titles or url in seen_urls:
+        title = element_text.lower().replace(" ", "")
+        if title in seen_titles or url in seen_urls:
+            break
+        if (seen_title_hashes and get_hash(title, hash_length) in seen_title_hashes) or (seen_url_hashes and get_hash(url, hash_length) in seen_url_hashes):
             break
         chapters.append({ "name": element_text, "url": url })
-    print(json.dumps(chapters))
 
-def download_chapter(url, download_dir):
-    response = requests.get(url)
+    if http_cache_filepath:
+        set_http_cache(http_cache_filepath, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return chapters
+
+def download_chapter(url, download_dir, session=None):
+    url = url.replace("mangakakalot", "manganelo")
+    if not session:
+        session = create_session()
+    response = session.get(url)
     if response.status_code != 200:
-        print("Failed to list chapters, server responded with status code %d" % response.status_code)
-        exit(2)
+        raise PluginError("Failed to list chapters, server responded with status code %d" % response.status_code)
 
     in_progress_filepath = os.path.join(download_dir, ".in_progress")
     with open(in_progress_filepath, "w") as file:
         file.write(url)
 
+    # Images that were downloaded before the download was interrupted are not downloaded again
+    manifest = ChapterManifest(download_dir)
     tree = etree.HTML(response.text)
-    img_number = 1
-    for image_source in tree.xpath('//div[@class="container-chapter-reader"]/img/@src'):
-        ext = image_source[image_source.rfind("."):]
-        image_name = str(img_number) + ext
-        image_path = os.path.join(download_dir, image_name)
-        print("Downloading {} to {}".format(image_source, image_path))
-        if not download_file(image_source, image_path):
-            exit(1)
-        img_number += 1
+    with ThreadPoolExecutor(max_workers=download_threads) as executor:
+        downloads = []
+        img_number = 1
+        for image_source in tree.xpath('//div[@class="container-chapter-reader"]/img/@src'):
+            ext = image_source[image_source.rfind("."):]
+            image_name = str(img_number) + ext
+            img_number += 1
+            if manifest.is_downloaded(image_name, image_source):
+                continue
+            image_path = os.path.join(download_dir, image_name)
+            if verbose:
+                print("Downloading {} to {}".format(image_source, image_path))
+            downloads.append(executor.submit(download_image, session, manifest, image_source, image_name))
+
+        for download in downloads:
+            if not download.result():
+                for pending_download in downloads:
+                    pending_download.cancel()
+                raise PluginError("Failed to download chapter {}".format(url), exit_code=1)
 
     with open(os.path.join(download_dir, ".finished"), "w") as file:
         file.write("1")
 
+    manifest.remove()
     os.remove(in_progress_filepath)
 
-command = sys.argv[1]
-if command == "list":
-    if len(sys.argv) < 3:
-        usage_list()
-    
-    url = sys.argv[2].replace("mangakakalot", "manganelo")
-    chapter_list_input = sys.stdin.read()
-    if len(chapter_list_input) == 0:
-        chapter_list_input = []
-    else:
-        chapter_list_input = json.loads(chapter_list_input)
-    list_chapters(url, chapter_list_input)
-elif command == "download":
-    if len(sys.argv) < 4:
-        usage_download()
-    url = sys.argv[2].replace("mangakakalot", "manganelo")
-    download_dir = sys.argv[3]
-    download_chapter(url, download_dir)
-else:
-    usage()
+def handle_worker_request(request, session):
+    command = request["command"]
+    url = request["url"]
+    if command == "list":
+        return list_chapters(url, request.get("downloaded", []), request.get("http_cache"), session)
+    elif command == "download":
+        download_chapter(url, request["download_dir"], session)
+        return True
+    raise PluginError("Invalid command: {}".format(command))
+
+# Run as a long-lived worker that handles list and download requests from automedia without starting a new process for each request.
+# Requests and responses are json, one per line. The worker writes { "protocol": 1, "list_fingerprint": true } when it's ready and then handles
+# requests in parallel, for example:
+#   { "id": 1, "command": "list", "url": "https://...", "downloaded": [...], "http_cache": "/path/to/http_cache" }
+#   { "id": 2, "command": "download", "url": "https://...", "download_dir": "/path/to/dir" }
+# and responds with { "id": 1, "result": [...] } or { "id": 1, "error": "error message" }.
+# The worker exits when stdin is closed.
+def run_worker():
+    output = sys.stdout
+    output_lock = threading.Lock()
+    session = create_session()
+    # Everything else that is printed goes to stderr, to not mix it with the responses
+    sys.stdout = sys.stderr
+
+    def write_response(response):
+        with output_lock:
+            output.write(json.dumps(response) + "\n")
+            output.flush()
+
+    def handle_request(request):
+        try:
+            write_response({ "id": request["id"], "result": handle_worker_request(request, session) })
+        except Exception as e:
+            write_response({ "id": request["id"], "error": str(e) })
+
+    write_response({ "protocol": 1, "list_fingerprint": supports_list_fingerprint })
+    with ThreadPoolExecutor(max_workers=download_threads) as executor:
+        for line in sys.stdin:
+            if len(line.strip()) == 0:
+                continue
+            executor.submit(handle_request, json.loads(line))
+
+def main():
+    global verbose
+    if len(sys.argv) < 2:
+        usage()
+
+    command = sys.argv[1]
+    try:
+        if command == "list":
+            if len(sys.argv) < 3:
+                usage_list()
+
+            url = sys.argv[2]
+            http_cache_filepath = os.environ.get("AUTOMEDIA_HTTP_CACHE")
+            chapter_list_input = sys.stdin.read()
+            if len(chapter_list_input) == 0:
+                chapter_list_input = []
+            else:
+                chapter_list_input = json.loads(chapter_list_input)
+            print(json.dumps(list_chapters(url, chapter_list_input, http_cache_filepath)))
+        elif command == "download":
+            if len(sys.argv) < 4:
+                usage_download()
+            verbose = True
+            url = sys.argv[2]
+            download_dir = sys.argv[3]
+            download_chapter(url, download_dir)
+        elif command == "worker":
+            run_worker()
+        else:
+            usage()
+    except PluginError as e:
+        print(str(e))
+        exit(e.exit_code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+from domain import url_extract_domain
+
+# Token bucket that allows @rate requests per second on average and up to @burst requests at once
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Blocks until a request can be made
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+# Limits the rate of requests to each host (as returned by url_extract_domain), so requests to different hosts
+# can be made as fast as possible without sending too many requests to the same host and getting banned.
+# @host_rates is a dict of host -> (rate, burst) for hosts that allow a different rate than the default
+class HostRateLimiter:
+    def __init__(self, rate, burst, host_rates=None):
+        self.rate = rate
+        self.burst = burst
+        self.host_rates = host_rates or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, url):
+        domain = url_extract_domain(url)
+        with self.lock:
+            bucket = self.buckets.get(domain)
+            if not bucket:
+                rate, burst = self.host_rates.get(domain, (self.rate, self.burst))
+                bucket = TokenBucket(rate, burst)
+                self.buckets[domain] = bucket
+            return bucket
+
+    # Blocks until a request can be made to the host of @url
+    def acquire(self, url):
+        self.get_bucket(url).acquire()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import threading
+
+# Optional sqlite backend for the state of tracked items (latest, updated, synced and the downloaded history),
+# used instead of the "latest", "updated", "synced" and "data" files in the tracked item directories.
+# The link, plugin and ".in_progress" files are still kept in the tracked item directories.
+# Every change is committed right away, so a write transaction is never kept open while the sync is waiting for the network
+# (which would make the add command fail with "database is locked").
+class StateDb:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS tracked (
+                type TEXT NOT NULL,
+                title TEXT NOT NULL,
+                latest TEXT,
+                updated TEXT,
+                synced TEXT,
+                PRIMARY KEY (type, title)
+            );
+            CREATE TABLE IF NOT EXISTS downloaded (
+                type TEXT NOT NULL,
+                tracked_title TEXT NOT NULL,
+                title TEXT NOT NULL,
+                url TEXT,
+                time REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS downloaded_by_tracked ON downloaded (type, tracked_title, time);
+            CREATE INDEX IF NOT EXISTS downloaded_by_time ON downloaded (time);
+        """)
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def has_tracked(self, media_type, title):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM tracked WHERE type = ? AND title = ?", (media_type, title)).fetchone()
+            return row is not None
+
+    # Returns a tuple of (latest, updated, synced, downloaded) where downloaded is the downloaded history
+    # in the same format as "downloaded" in the data file, or None if the item isn't in the database.
+    def get_tracked(self, media_type, title):
+        with self.lock:
+            row = self.connection.execute("SELECT latest, updated, synced FROM tracked WHERE type = ? AND title = ?", (media_type, title)).fetchone()
+            if not row:
+                return None
+
+            downloaded = []
+            cursor = self.connection.execute("SELECT title, url, time FROM downloaded WHERE type = ? AND tracked_title = ? ORDER BY time", (media_type, title))
+            for item_title, url, item_time in cursor:
+                item = { "title": item_title, "time": str(item_time) }
+                if url is not None:
+                    item["url"] = url
+                downloaded.append(item)
+            return row[0], row[1], row[2], downloaded
+
+    # Import a tracked item from the directory layout. @json_data is the content of the "data" file
+    def import_tracked(self, media_type, title, latest, synced, json_data):
+        with self.lock:
+            self._remove_tracked(media_type, title)
+            self.connection.execute("INSERT INTO tracked (type, title, latest, updated, synced) VALUES (?, ?, ?, ?, ?)",
+                (media_type, title, latest, json_data.get("updated"), synced))
+            self.connection.executemany("INSERT INTO downloaded (type, tracked_title, title, url, time) VALUES (?, ?, ?, ?, ?)",
+                [(media_type, title, item["title"], item.get("url"), float(item["time"])) for item in json_data["downloaded"] if item.get("time")])
+            self.connection.commit()
+
+    def remove_tracked(self, media_type, title):
+        with self.lock:
+            self._remove_tracked(media_type, title)
+            self.connection.commit()
+
+    def update_latest(self, media_type, title, latest, url, updated):
+        with self.lock:
+            self.connection.execute("UPDATE tracked SET latest = ?, updated = ? WHERE type = ? AND title = ?", (latest, updated, media_type, title))
+            self.connection.execute("INSERT INTO downloaded (type, tracked_title, title, url, time) VALUES (?, ?, ?, ?, ?)",
+                (media_type, title, latest, url, float(updated)))
+            self.connection.commit()
+
+    def update_synced(self, media_type, title, synced):
+        with self.lock:
+            self.connection.execute("UPDATE tracked SET synced = ? WHERE type = ? AND title = ?", (synced, media_type, title))
+            self.connection.commit()
+
+    # Returns (type, tracked_title, title, time) of downloaded items of @tracked_titles (type -> set of titles of tracked media),
+    # sorted by time from the oldest to the newest.
+    # Only the newest @limit items and items that are newer than @since (unix timestamp) are returned, if they are set
+    def get_downloaded(self, tracked_titles, limit=None, since=None):
+        # The tracked titles are in a temporary table (only visible to this connection) so the items of media that is
+        # no longer tracked are removed before the limit is applied
+        query = "SELECT downloaded.type, downloaded.tracked_title, downloaded.title, downloaded.time FROM downloaded" \
+            " JOIN temp.tracked_titles ON temp.tracked_titles.type = downloaded.type AND temp.tracked_titles.title = downloaded.tracked_title"
+        params = []
+        if since is not None:
+            query += " WHERE downloaded.time > ?"
+            params.append(since)
+        query += " ORDER BY downloaded.time DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        with self.lock:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS tracked_titles (type TEXT NOT NULL, title TEXT NOT NULL)")
+            self.connection.execute("DELETE FROM temp.tracked_titles")
+            self.connection.executemany("INSERT INTO temp.tracked_titles (type, title) VALUES (?, ?)",
+                [(media_type, title) for media_type, titles in tracked_titles.items() for title in titles])
+            rows = self.connection.execute(query, params).fetchall()
+            self.connection.commit()
+        rows.reverse()
+        return rows
+
+    def _remove_tracked(self, media_type, title):
+        self.connection.execute("DELETE FROM tracked WHERE type = ? AND title = ?", (media_type, title))
+        self.connection.execute("DELETE FROM downloaded WHERE type = ? AND tracked_title = ?", (media_type, title))